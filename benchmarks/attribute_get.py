@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""Compare scalar attribute reads on SQLAlchemy models before patching, after
+patching with no active profiler, and inside a `Profiler`.
+
+    PYTHONPATH=. python benchmarks/attribute_get.py
+"""
+
+from __future__ import print_function
+
+import timeit
+
+import sqlalchemy as sa
+from sqlalchemy.ext.declarative import declarative_base
+
+ROWS = 1000
+REPEAT = 5
+NUMBER = 200
+
+Base = declarative_base()
+
+
+class User(Base):
+    __tablename__ = 'user'
+    id = sa.Column(sa.Integer, primary_key=True)
+    name = sa.Column(sa.String)
+
+
+def make_session():
+    engine = sa.create_engine('sqlite:///:memory:')
+    Base.metadata.create_all(bind=engine)
+    session = sa.orm.sessionmaker(bind=engine)()
+    session.add_all([User(id=index, name=str(index)) for index in range(ROWS)])
+    session.commit()
+    return session
+
+
+def read_attributes(users):
+    for user in users:
+        user.id
+        user.name
+
+
+def measure(label, users, baseline=None):
+    best = min(timeit.repeat(
+        lambda: read_attributes(users),
+        repeat=REPEAT,
+        number=NUMBER,
+    ))
+    ratio = ' ({0:.2f}x)'.format(best / baseline) if baseline else ''
+    print('{0:<12} {1:.4f}s{2}'.format(label, best, ratio))
+    return best
+
+
+def main():
+    session = make_session()
+    users = session.query(User).all()
+    baseline = measure('unpatched', users)
+
+    import nplusone.ext.sqlalchemy
+    from nplusone.core import profiler
+
+    # Patch now rather than when the first session starts, so that the
+    # inactive run measures the patched ORM
+    nplusone.ext.sqlalchemy.install()
+
+    measure('inactive', users, baseline)
+    with profiler.Profiler():
+        measure('active', users, baseline)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""Compare formatted string identity keys with `(model, pk)` tuples over a
+100k-row SQLAlchemy query: time to build the keys for every row, and memory
+retained once they are stored in `LazyListener.loaded` (a `set` of strings
+before, an `IdentitySet` of tuples now).
+
+    PYTHONPATH=. python benchmarks/identity_keys.py
+"""
+
+from __future__ import print_function
+
+import time
+import tracemalloc
+
+import sqlalchemy as sa
+from sqlalchemy.ext.declarative import declarative_base
+
+from nplusone.core.listeners import IdentitySet
+from nplusone.ext.sqlalchemy import to_key
+from nplusone.ext.sqlalchemy import get_primary_keys
+
+ROWS = 100000
+
+Base = declarative_base()
+
+
+class User(Base):
+    __tablename__ = 'user'
+    id = sa.Column(sa.Integer, primary_key=True)
+
+
+def to_string_key(instance):
+    model = type(instance)
+    return ':'.join(
+        [model.__name__] +
+        [
+            format(instance.__dict__.get(key.key))
+            for key in get_primary_keys(model)
+        ]
+    )
+
+
+def make_rows():
+    engine = sa.create_engine('sqlite:///:memory:')
+    Base.metadata.create_all(bind=engine)
+    engine.execute(User.__table__.insert(), [{'id': index} for index in range(ROWS)])
+    session = sa.orm.sessionmaker(bind=engine)()
+    return session.query(User).all()
+
+
+def measure(label, func, container, rows):
+    start = time.time()
+    for row in rows:
+        func(row)
+    elapsed = time.time() - start
+    tracemalloc.start()
+    keys = container()
+    for row in rows:
+        keys.add(func(row))
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print('{0:<8} {1:.3f}s {2:>8.1f} KiB'.format(label, elapsed, size / 1024.0))
+    return keys
+
+
+def main():
+    rows = make_rows()
+    measure('string', to_string_key, set, rows)
+    measure('tuple', to_key, IdentitySet, rows)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""Compare `joinedload` queries before patching, after patching with no active
+profiler, and inside a `Profiler`. Exercises the per-row `_populate_full`
+hook that emits `eager_load`.
+
+    PYTHONPATH=. python benchmarks/joinedload.py
+"""
+
+from __future__ import print_function
+
+import timeit
+
+import sqlalchemy as sa
+from sqlalchemy.ext.declarative import declarative_base
+
+ROWS = 2000
+REPEAT = 5
+NUMBER = 5
+
+Base = declarative_base()
+
+
+class User(Base):
+    __tablename__ = 'user'
+    id = sa.Column(sa.Integer, primary_key=True)
+    addresses = sa.orm.relationship('Address')
+
+
+class Address(Base):
+    __tablename__ = 'address'
+    id = sa.Column(sa.Integer, primary_key=True)
+    user_id = sa.Column(sa.Integer, sa.ForeignKey('user.id'))
+
+
+def make_session():
+    engine = sa.create_engine('sqlite:///:memory:')
+    Base.metadata.create_all(bind=engine)
+    session = sa.orm.sessionmaker(bind=engine)()
+    session.add_all([
+        User(id=index, addresses=[Address(), Address()])
+        for index in range(ROWS)
+    ])
+    session.commit()
+    return session
+
+
+def query(session):
+    users = session.query(User).options(sa.orm.joinedload(User.addresses)).all()
+    for user in users:
+        user.addresses
+    session.expunge_all()
+
+
+def measure(label, session, baseline=None):
+    best = min(timeit.repeat(
+        lambda: query(session),
+        repeat=REPEAT,
+        number=NUMBER,
+    ))
+    ratio = ' ({0:.2f}x)'.format(best / baseline) if baseline else ''
+    print('{0:<12} {1:.4f}s{2}'.format(label, best, ratio))
+    return best
+
+
+def main():
+    session = make_session()
+    baseline = measure('unpatched', session)
+
+    import nplusone.ext.sqlalchemy
+    from nplusone.core import profiler
+
+    # Patch now rather than when the first session starts, so that the
+    # inactive run measures the patched ORM
+    nplusone.ext.sqlalchemy.install()
+
+    measure('inactive', session, baseline)
+    with profiler.Profiler():
+        measure('active', session, baseline)
+
+
+if __name__ == '__main__':
+    main()
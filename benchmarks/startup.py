@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""Measure the startup cost of each ORM extension: time to import the
+extension once its ORM is loaded, and latency of the first profiled request.
+Patches are either installed on import, as in earlier releases, or deferred to
+the first profiling session. Each measurement runs in a fresh interpreter;
+run with bytecode caching enabled, or compiling sources dominates imports.
+
+    PYTHONPATH=. python benchmarks/startup.py
+"""
+
+from __future__ import print_function
+
+import sys
+import textwrap
+import subprocess
+
+RUNS = 5
+
+TEMPLATE = '''
+import sys
+import time
+
+{setup}
+
+start = time.time()
+import {module} as ext
+if sys.argv[1] == 'eager':
+    ext.install()
+imported = time.time() - start
+
+from nplusone.core import profiler
+start = time.time()
+with profiler.Profiler():
+    {request}
+first = time.time() - start
+
+print(imported, first)
+'''
+
+EXTENSIONS = [
+    (
+        'sqlalchemy',
+        'nplusone.ext.sqlalchemy',
+        '''
+        import sqlalchemy as sa
+        from sqlalchemy.ext.declarative import declarative_base
+
+        Base = declarative_base()
+
+        class User(Base):
+            __tablename__ = 'user'
+            id = sa.Column(sa.Integer, primary_key=True)
+            addresses = sa.orm.relationship('Address', backref='user')
+
+        class Address(Base):
+            __tablename__ = 'address'
+            id = sa.Column(sa.Integer, primary_key=True)
+            user_id = sa.Column(sa.Integer, sa.ForeignKey('user.id'))
+
+        engine = sa.create_engine('sqlite:///:memory:')
+        Base.metadata.create_all(bind=engine)
+        session = sa.orm.sessionmaker(bind=engine)()
+        sa.orm.configure_mappers()
+        ''',
+        'session.query(User).all()',
+    ),
+    (
+        'peewee',
+        'nplusone.ext.peewee',
+        '''
+        import peewee as pw
+
+        db = pw.SqliteDatabase(':memory:')
+
+        class User(pw.Model):
+            class Meta:
+                database = db
+
+        class Address(pw.Model):
+            user = pw.ForeignKeyField(User, backref='addresses')
+
+            class Meta:
+                database = db
+
+        db.create_tables([User, Address])
+        ''',
+        'list(User.select())',
+    ),
+    (
+        'django',
+        'nplusone.ext.django.patch',
+        '''
+        import django
+        from django.conf import settings
+        from django.core.management import call_command
+
+        settings.configure(
+            INSTALLED_APPS=[
+                'django.contrib.auth',
+                'django.contrib.contenttypes',
+            ],
+            DATABASES={
+                'default': {
+                    'ENGINE': 'django.db.backends.sqlite3',
+                    'NAME': ':memory:',
+                },
+            },
+        )
+        django.setup()
+        call_command('migrate', verbosity=0)
+
+        from django.contrib.auth.models import User
+        ''',
+        'list(User.objects.all())',
+    ),
+]
+
+
+def measure(module, setup, request, mode):
+    script = TEMPLATE.format(
+        setup=textwrap.dedent(setup),
+        module=module,
+        request=request,
+    )
+    results = []
+    for _ in range(RUNS):
+        output = subprocess.check_output([sys.executable, '-c', script, mode])
+        results.append([float(value) for value in output.split()])
+    # Report medians across runs
+    return [sorted(values)[len(values) // 2] for values in zip(*results)]
+
+
+def main():
+    print('{0:<12} {1:<10} {2:>10} {3:>15}'.format(
+        'extension', 'mode', 'import', 'first request',
+    ))
+    for name, module, setup, request in EXTENSIONS:
+        for mode in ['eager', 'deferred']:
+            try:
+                imported, first = measure(module, setup, request, mode)
+            except subprocess.CalledProcessError:
+                print('{0:<12} {1:<10} unavailable'.format(name, mode))
+                continue
+            print('{0:<12} {1:<10} {2:>9.2f}ms {3:>14.2f}ms'.format(
+                name, mode, imported * 1000, first * 1000,
+            ))
+
+
+if __name__ == '__main__':
+    main()
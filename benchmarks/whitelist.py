@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""Compare matching messages against a large whitelist as a list of rules,
+checked one by one, and as a compiled `Whitelist`.
+
+    PYTHONPATH=. python benchmarks/whitelist.py
+"""
+
+from __future__ import print_function
+
+import timeit
+
+from nplusone.core import listeners
+
+RULES = 500
+MODELS = 50
+REPEAT = 5
+NUMBER = 20
+
+
+def make_models():
+    return [type('Model{0}'.format(index), (object, ), {}) for index in range(MODELS)]
+
+
+def make_items():
+    items = []
+    for index in range(RULES):
+        if index % 2:
+            items.append({'model': 'Other{0}'.format(index), 'field': 'field'})
+        else:
+            items.append({'model': 'Other{0}*'.format(index), 'label': 'n_plus_one'})
+    return items
+
+
+def match(rules, models):
+    for model in models:
+        for field in ['first', 'second', 'third']:
+            listeners.Message(model, field).match(rules)
+
+
+def measure(label, rules, models, baseline=None):
+    best = min(timeit.repeat(
+        lambda: match(rules, models),
+        repeat=REPEAT,
+        number=NUMBER,
+    ))
+    ratio = ' ({0:.2f}x)'.format(best / baseline) if baseline else ''
+    print('{0:<12} {1:.4f}s{2}'.format(label, best, ratio))
+    return best
+
+
+def main():
+    models = make_models()
+    items = make_items()
+    baseline = measure('rules', [listeners.Rule(**item) for item in items], models)
+    measure('compiled', listeners.Whitelist(items), models, baseline)
+
+
+if __name__ == '__main__':
+    main()
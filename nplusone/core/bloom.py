@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+
+import math
+
+
+class BloomFilter(object):
+    """Fixed-size Bloom filter over hashable keys. Membership tests never
+    return false negatives; the false positive rate stays near `error_rate`
+    for up to `capacity` keys and grows as more keys are added: with the
+    default 1% error rate, to about 6% at 1.5 times the capacity, 16% at twice,
+    44% at three times, 83% at five times, and over 99% at ten times the
+    capacity, at which point nearly every key tests as a member.
+    """
+
+    def __init__(self, capacity=1000000, error_rate=0.01):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = int(math.ceil(
+            -capacity * math.log(error_rate) / math.log(2) ** 2
+        ))
+        self.hashes = max(int(round(self.size / float(capacity) * math.log(2))), 1)
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def indexes(self, key):
+        # Double hashing: derive all probe positions from two hash values
+        first = hash(key)
+        second = hash((key, self.size)) | 1
+        for index in range(self.hashes):
+            yield (first + index * second) % self.size
+
+    def add(self, key):
+        for index in self.indexes(key):
+            self.bits[index >> 3] |= 1 << (index & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        return all(
+            self.bits[index >> 3] & (1 << (index & 7))
+            for index in self.indexes(key)
+        )
+
+    def __len__(self):
+        return self.count
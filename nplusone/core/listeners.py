@@ -1,9 +1,14 @@
 # -*- coding: utf-8 -*-
 
+import re
 import six
 import fnmatch
+import threading
 from collections import defaultdict
+from collections import OrderedDict
 
+from nplusone.core import bloom
+from nplusone.core import stats
 from nplusone.core import signals
 
 
@@ -26,15 +31,112 @@ class Rule(object):
         return (
             self.model is model or (
                 isinstance(self.model, six.string_types) and
-                fnmatch.fnmatch(model.__name__, self.model)
+                fnmatch.fnmatch(self.model_name(model), self.model)
             )
         )
 
+    @staticmethod
+    def model_name(model):
+        """Name matched against string `model` patterns."""
+        return model.__name__
+
+
+# Characters that make `fnmatch` patterns match more than one string
+GLOB = re.compile(r'[*?[]')
+
+# Matches any label or field in the subjects built by `Whitelist.match_glob`
+ANY = '[^\x00]*'
+
+
+def translate(pattern):
+    # Strip the end anchor, and trailing flags on Python < 3.6, so that the
+    # pattern can be embedded in a larger expression
+    regex = fnmatch.translate(pattern)
+    return regex[:regex.rindex('\\Z')]
+
+
+class Whitelist(object):
+    """Whitelist rules compiled for matching. Rules with exact model names or
+    classes are indexed by label and field; rules with glob model patterns are
+    combined into a single regular expression over `label`, model name and
+    `field`. Decisions are cached per `(label, model, field)`, evicting the
+    oldest entries beyond `max_size`.
+    """
+
+    def __init__(self, items=None, rule=Rule, max_size=10000):
+        self.rule = rule
+        self.rules = [rule(**item) for item in (items or [])]
+        self.max_size = max_size
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.exact = defaultdict(set)
+        patterns = []
+        for each in self.rules:
+            if not (each.label or each.model or each.field):
+                continue
+            if isinstance(each.model, six.string_types) and GLOB.search(each.model):
+                patterns.append(
+                    '\x00'.join([
+                        re.escape(each.label) if each.label else ANY,
+                        translate(each.model),
+                        re.escape(each.field) if each.field else ANY,
+                    ])
+                )
+            else:
+                self.exact[(each.label, each.field)].add(each.model)
+        self.globs = (
+            re.compile('(?:{0})\\Z'.format('|'.join(patterns)))
+            if patterns
+            else None
+        )
+
+    def __len__(self):
+        return len(self.rules)
+
+    def match(self, label, model, field):
+        key = (label, model, field)
+        decision = self.cache.get(key)
+        if decision is None:
+            decision = self.match_exact(label, model, field) or self.match_glob(
+                label, model, field,
+            )
+            with self.lock:
+                self.cache[key] = decision
+                while len(self.cache) > self.max_size:
+                    self.cache.popitem(last=False)
+        return decision
+
+    def match_exact(self, label, model, field):
+        name = None
+        for key in ((label, field), (label, None), (None, field), (None, None)):
+            models = self.exact.get(key)
+            if not models:
+                continue
+            if None in models or model in models:
+                return True
+            name = name or self.rule.model_name(model)
+            if name in models:
+                return True
+        return False
+
+    def match_glob(self, label, model, field):
+        if self.globs is None:
+            return False
+        subject = '\x00'.join([label, self.rule.model_name(model), field])
+        return self.globs.match(subject) is not None
+
 
 class Message(object):
 
     label = ''
     formatter = ''
+    # Probability that the request was profiled; divide counts by this value
+    # to extrapolate to all requests
+    sample_rate = 1.0
+    # Number of detections reported by this message when aggregating
+    count = 1
+    # Endpoint of the profiled request, if known
+    endpoint = None
 
     def __init__(self, model, field):
         self.model = model
@@ -42,13 +144,18 @@ class Message(object):
 
     @property
     def message(self):
-        return self.formatter.format(
+        message = self.formatter.format(
             label=self.label,
             model=self.model.__name__,
             field=self.field,
         )
+        if self.count > 1:
+            message += ' ({0} times)'.format(self.count)
+        return message
 
     def match(self, rules):
+        if isinstance(rules, Whitelist):
+            return rules.match(self.label, self.model, self.field)
         return any(
             rule.compare(self.label, self.model, self.field)
             for rule in rules
@@ -65,25 +172,138 @@ class EagerLoadMessage(Message):
     formatter = 'Potential unnecessary eager load detected on `{model}.{field}`'
 
 
+class IdentitySet(object):
+    """Set of `(model, pk)` identity keys, stored as per-model sets of primary
+    keys so that members share the primary key objects of loaded instances
+    rather than retaining a tuple per key.
+
+    When `max_size` is set, keys added once the exact sets hold `max_size`
+    keys go to a `BloomFilter` instead, bounding memory at the cost of false
+    positive membership tests (see `BloomFilter` for rates). The filter is
+    sized for `capacity` keys, defaulting to `max_size` and at least
+    `MIN_CAPACITY`. `overflowed` counts keys tracked approximately, and the
+    class-level `fallbacks` counts sets in the process that have engaged the
+    fallback.
+    """
+    fallbacks = 0
+
+    MIN_CAPACITY = 1000
+
+    def __init__(self, max_size=None, capacity=None):
+        self.data = defaultdict(set)
+        self.max_size = max_size
+        self.capacity = max(capacity or max_size or 0, self.MIN_CAPACITY)
+        self.size = 0
+        self.overflow = None
+        self.overflowed = 0
+
+    def add(self, key):
+        model, pk = key
+        pks = self.data[model]
+        if pk in pks:
+            return
+        if self.max_size is not None and self.size >= self.max_size:
+            self.add_overflow(key)
+            return
+        pks.add(pk)
+        self.size += 1
+
+    def add_overflow(self, key):
+        if self.overflow is None:
+            self.overflow = bloom.BloomFilter(capacity=self.capacity)
+            IdentitySet.fallbacks += 1
+        self.overflow.add(key)
+        self.overflowed += 1
+
+    def update(self, keys):
+        for key in keys:
+            self.add(key)
+
+    def __contains__(self, key):
+        model, pk = key
+        pks = self.data.get(model)
+        return (
+            (pks is not None and pk in pks) or
+            (self.overflow is not None and key in self.overflow)
+        )
+
+    def __len__(self):
+        return self.size + self.overflowed
+
+
 class Listener(object):
 
     def __init__(self, parent):
         self.parent = parent
+        self.session = signals.get_session()
+        self.aggregated = (
+            OrderedDict()
+            if self.session is not None and self.session.aggregate
+            else None
+        )
 
     def setup(self):
         pass  # pragma: no cover
 
     def teardown(self):
-        pass  # pragma: no cover
+        self.flush()
+
+    def notify(self, message):
+        if self.session is not None:
+            message.sample_rate = self.session.sample_rate
+            message.endpoint = self.session.endpoint
+        if self.aggregated is None:
+            self.report(message)
+            return
+        key = (message.label, message.model, message.field)
+        if key in self.aggregated:
+            self.aggregated[key].count += 1
+        else:
+            self.aggregated[key] = message
+
+    def flush(self):
+        """Report aggregated messages, once per distinct issue."""
+        if not self.aggregated:
+            return
+        aggregated = list(self.aggregated.values())
+        self.aggregated.clear()
+        for message in aggregated:
+            self.report(message)
+
+    def report(self, message):
+        """Pass `message` to the parent, counting it as detected and
+        recording it in process-wide statistics unless the parent returns
+        `False` to indicate that it was whitelisted. Messages that raise count
+        as detected.
+        """
+        reported = True
+        try:
+            reported = self.parent.notify(message) is not False
+        finally:
+            if reported and self.session is not None:
+                self.session.detections += message.count
+                stats.record(
+                    message.endpoint,
+                    message.label,
+                    message.model,
+                    message.field,
+                    sample_rate=message.sample_rate,
+                    count=message.count,
+                )
 
 
 class LazyListener(Listener):
 
     def setup(self):
-        self.loaded, self.ignore = set(), set()
-        signals.load.connect(self.handle_load, sender=signals.get_worker())
-        signals.ignore_load.connect(self.handle_ignore, sender=signals.get_worker())
-        signals.lazy_load.connect(self.handle_lazy, sender=signals.get_worker())
+        max_tracked = capacity = None
+        if self.session is not None:
+            max_tracked = self.session.max_tracked
+            capacity = self.session.bloom_capacity
+        self.loaded = IdentitySet(max_size=max_tracked, capacity=capacity)
+        self.ignore = IdentitySet(max_size=max_tracked, capacity=capacity)
+        signals.connect(signals.load, self.handle_load)
+        signals.connect(signals.ignore_load, self.handle_ignore)
+        signals.connect(signals.lazy_load, self.handle_lazy)
 
     def handle_load(self, caller, args=None, kwargs=None, context=None, ret=None,
                     parser=None):
@@ -100,52 +320,74 @@ class LazyListener(Listener):
         model, instance, field = parser(args, kwargs, context)
         if instance in self.loaded and instance not in self.ignore:
             message = LazyLoadMessage(model, field)
-            self.parent.notify(message)
+            self.notify(message)
 
 
 class EagerListener(Listener):
 
     def setup(self):
-        signals.eager_load.connect(self.handle_eager, sender=signals.get_worker())
+        signals.connect(signals.eager_load, self.handle_eager)
         self.tracker = EagerTracker()
-        self.touched = []
+        self.subscribed = False
 
     def teardown(self):
         self.log_eager()
+        self.flush()
 
     def handle_eager(self, caller, args=None, kwargs=None, context=None, ret=None,
                      parser=None):
         self.tracker.track(*parser(args, kwargs, context))
-        signals.touch.connect(self.handle_touch, sender=signals.get_worker())
+        # Only follow touches once something has been eager loaded
+        if not self.subscribed:
+            signals.connect(signals.touch, self.handle_touch)
+            self.subscribed = True
 
     def handle_touch(self, caller, args=None, kwargs=None, context=None, ret=None,
                      parser=None):
-        self.touched.append(parser(args, kwargs, context))
+        touched = parser(args, kwargs, context)
+        if touched:
+            self.tracker.touch(*touched)
 
     def log_eager(self):
-        self.tracker.prune([each for each in self.touched if each])
         for model, field in self.tracker.unused:
             message = EagerLoadMessage(model, field)
-            self.parent.notify(message)
+            self.notify(message)
 
 
 class EagerTracker(object):
     """Data structure for tracking eager-loaded and subsequently touched
     related rows. Eager-loaded rows are stored in a dict mapping associations
-    to nested dicts mapping query keys to instances.
+    to the keys of queries with no touched rows, and an inverted index mapping
+    each association and instance to the keys of the queries that loaded it.
+    Each touch removes the affected query keys as it arrives, so that unused
+    associations are known without a final scan.
     """
     def __init__(self):
-        self.data = defaultdict(lambda: defaultdict(set))
+        self.data = defaultdict(set)
+        self.index = defaultdict(set)
+        self.used = set()
 
     def track(self, model, field, instances, key):
-        self.data[(model, field)][key].update(instances)
-
-    def prune(self, touched):
-        for model, field, touch_instances in touched:
-            group = self.data[(model, field)]
-            for key, fetch_instances in list(group.items()):
-                if touch_instances and fetch_instances.intersection(touch_instances):
-                    group.pop(key, None)
+        association = (model, field)
+        if (association, key) in self.used:
+            return
+        self.data[association].add(key)
+        for instance in instances:
+            self.index[(association, instance)].add(key)
+
+    def touch(self, model, field, instances):
+        """Prune the queries that loaded `instances` for the association. Touches
+        on associations without untouched eager loads return before consuming
+        `instances`, which parsers may compute lazily.
+        """
+        association = (model, field)
+        group = self.data.get(association)
+        if not group:
+            return
+        for instance in instances:
+            for key in self.index.pop((association, instance), ()):
+                group.discard(key)
+                self.used.add((association, key))
 
     @property
     def unused(self):
@@ -160,3 +402,45 @@ listeners = {
     'lazy_load': LazyListener,
     'eager_load': EagerListener,
 }
+
+
+def get_options(config):
+    """Session options from integration config."""
+    options = {}
+    if config.get('NPLUSONE_DEFERRED'):
+        options['deferred'] = True
+        if 'NPLUSONE_BUFFER_SIZE' in config:
+            options['buffer_size'] = config['NPLUSONE_BUFFER_SIZE']
+    if config.get('NPLUSONE_MAX_TRACKED') is not None:
+        options['max_tracked'] = config['NPLUSONE_MAX_TRACKED']
+        if config.get('NPLUSONE_BLOOM_CAPACITY') is not None:
+            options['bloom_capacity'] = config['NPLUSONE_BLOOM_CAPACITY']
+    if config.get('NPLUSONE_AGGREGATE'):
+        options['aggregate'] = True
+    return options
+
+
+def start(parent, **options):
+    """Start a profiling session in the current context and set up a listener
+    of each type reporting to `parent`. Options are passed to the session.
+    """
+    session = signals.start_session(**options)
+    for name, listener_type in six.iteritems(listeners):
+        session.listeners[name] = listener_type(parent)
+        session.listeners[name].setup()
+    return session
+
+
+def stop(session):
+    """Dispatch buffered events, tear down the listeners of `session`, and
+    end it.
+    """
+    try:
+        session.flush()
+        for name in six.iterkeys(listeners):
+            listener = session.listeners.pop(name, None)
+            if listener:
+                listener.teardown()
+    finally:
+        signals.end_session(session)
+        stats.tick()
@@ -1,14 +1,25 @@
 # -*- coding: utf-8 -*-
 
+import os
+import json
+import time
+import atexit
 import logging
+import weakref
+import threading
+from collections import deque
 
 from nplusone.core import exceptions
 
+logger = logging.getLogger(__name__)
+
 
 class Notifier(object):
 
     CONFIG_KEY = None
     ENABLED_DEFAULT = False
+    # Whether notifications may be delivered off the request path
+    DEFERRABLE = True
 
     @classmethod
     def is_enabled(cls, config):
@@ -44,6 +55,7 @@ class ErrorNotifier(Notifier):
 
     CONFIG_KEY = 'NPLUSONE_RAISE'
     ENABLED_DEFAULT = False
+    DEFERRABLE = False
 
     def __init__(self, config):
         self.error = config.get('NPLUSONE_ERROR', exceptions.NPlusOneError)
@@ -52,8 +64,203 @@ class ErrorNotifier(Notifier):
         raise self.error(message.message)
 
 
+class JSONNotifier(Notifier):
+    """Append a JSON record per message to the file at
+    `NPLUSONE_JSON_FILE`. Records are buffered and written together once
+    `NPLUSONE_JSON_BATCH_SIZE` are pending, or by a timer at most
+    `NPLUSONE_JSON_FLUSH_INTERVAL` seconds after they were buffered;
+    remaining records are written on exit. Failed writes are logged. Forked
+    processes start with an empty buffer.
+    """
+
+    CONFIG_KEY = 'NPLUSONE_JSON_FILE'
+    ENABLED_DEFAULT = False
+
+    def __init__(self, config):
+        self.path = config[self.CONFIG_KEY]
+        self.batch_size = config.get('NPLUSONE_JSON_BATCH_SIZE', 100)
+        self.interval = config.get('NPLUSONE_JSON_FLUSH_INTERVAL', 1)
+        self.lines = []
+        self.lock = threading.Lock()
+        self.starting = threading.Lock()
+        self.timer = None
+        self.pid = None
+        flush_on_exit(self)
+
+    def format(self, message, now):
+        return json.dumps({
+            'label': message.label,
+            'model': message.model.__name__,
+            'field': message.field,
+            'count': message.count,
+            'endpoint': message.endpoint,
+            'sample_rate': message.sample_rate,
+            'timestamp': now,
+            'pid': os.getpid(),
+        }) + '\n'
+
+    def notify(self, message):
+        # Reset state inherited from the parent in forked processes
+        if self.pid != os.getpid():
+            self.start()
+        line = self.format(message, time.time())
+        with self.lock:
+            self.lines.append(line)
+            if len(self.lines) < self.batch_size:
+                self.schedule()
+                return
+            lines, self.lines = self.lines, []
+        self.write(lines)
+
+    def start(self):
+        with self.starting:
+            if self.pid == os.getpid():
+                return
+            if self.pid is not None:
+                # Replace the lock that the parent may have held on fork, and
+                # leave records buffered by the parent, and its timer, to the
+                # parent
+                self.lock = threading.Lock()
+                self.lines = []
+                self.timer = None
+            self.pid = os.getpid()
+
+    def schedule(self):
+        """Start a timer to flush pending records, unless one is running.
+        Call with the lock held.
+        """
+        if self.timer is not None:
+            return
+        self.timer = threading.Timer(self.interval, self.flush)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def flush(self):
+        if self.pid != os.getpid():
+            self.start()
+        with self.lock:
+            lines, self.lines = self.lines, []
+            self.timer = None
+        self.write(lines)
+
+    def write(self, lines):
+        if not lines:
+            return
+        # Reopen for each batch to follow rotated files and forked processes
+        try:
+            with open(self.path, 'a') as fp:
+                fp.write(''.join(lines))
+        except (IOError, OSError):
+            logger.exception('Failed to write to %s', self.path)
+
+
+class AsyncNotifier(Notifier):
+    """Deliver messages to `notifiers` from a background thread, so that the
+    request path only pays for appending to a queue. The queue holds
+    `NPLUSONE_QUEUE_SIZE` messages; once full, the oldest queued message is
+    dropped for each new one and counted in `dropped`. Queued messages are
+    delivered on exit.
+    """
+
+    CONFIG_KEY = 'NPLUSONE_ASYNC'
+    ENABLED_DEFAULT = False
+
+    # Seconds between checks that the notifier is still referenced
+    POLL_INTERVAL = 1
+
+    def __init__(self, config, notifiers=None):
+        self.notifiers = notifiers or []
+        self.queue = deque(maxlen=config.get('NPLUSONE_QUEUE_SIZE', 10000))
+        self.dropped = 0
+        self.event = threading.Event()
+        self.lock = threading.Lock()
+        self.starting = threading.Lock()
+        self.pid = None
+        flush_on_exit(self)
+
+    def notify(self, message):
+        # Start the worker on first use, and again in forked processes
+        if self.pid != os.getpid():
+            self.start()
+        if len(self.queue) == self.queue.maxlen:
+            self.dropped += 1
+        self.queue.append(message)
+        self.event.set()
+
+    def start(self):
+        with self.starting:
+            if self.pid == os.getpid():
+                return
+            if self.pid is not None:
+                # Replace locks that the parent's worker may have held on fork,
+                # and leave messages queued by the parent to the parent
+                self.lock = threading.Lock()
+                self.event = threading.Event()
+                self.queue.clear()
+            thread = threading.Thread(
+                target=drain,
+                args=(weakref.ref(self), self.event, self.POLL_INTERVAL),
+            )
+            thread.daemon = True
+            thread.start()
+            self.pid = os.getpid()
+
+    def flush(self):
+        """Deliver queued messages in the calling thread."""
+        with self.lock:
+            while self.queue:
+                message = self.queue.popleft()
+                for notifier in self.notifiers:
+                    try:
+                        notifier.notify(message)
+                    except Exception:
+                        logger.exception('Failed to deliver %s', message.message)
+
+
+def drain(ref, event, interval):
+    """Flush the referenced notifier as messages arrive, until it is garbage
+    collected.
+    """
+    while True:
+        event.wait(interval)
+        event.clear()
+        notifier = ref()
+        if notifier is None:
+            return
+        notifier.flush()
+        del notifier
+
+
+# Notifiers with pending messages to deliver on exit, held weakly so that
+# rebuilding configuration releases the notifiers it replaces
+exiting = weakref.WeakSet()
+
+
+def flush_on_exit(notifier):
+    exiting.add(notifier)
+
+
+@atexit.register
+def flush_all():
+    # Drain asynchronous queues before flushing the notifiers that they feed
+    for notifier in sorted(
+        list(exiting),
+        key=lambda notifier: not isinstance(notifier, AsyncNotifier),
+    ):
+        notifier.flush()
+
+
 def init(config):
-    return [
-        notifier(config) for notifier in (LogNotifier, ErrorNotifier)
+    notifiers = [
+        notifier(config) for notifier in (LogNotifier, JSONNotifier, ErrorNotifier)
         if notifier.is_enabled(config)
     ]
+    if not AsyncNotifier.is_enabled(config):
+        return notifiers
+    deferrable = [notifier for notifier in notifiers if notifier.DEFERRABLE]
+    if not deferrable:
+        return notifiers
+    return [AsyncNotifier(config, deferrable)] + [
+        notifier for notifier in notifiers
+        if not notifier.DEFERRABLE
+    ]
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+
+import functools
+import threading
+
+# Serializes patching across extensions; reentrant so that `activate` can
+# install patchers while holding it
+lock = threading.RLock()
+
+# Patchers registered by extensions and not yet installed
+pending = []
+
+
+class Patcher(object):
+    """Apply an extension's patches and record how to undo them. `setup` is
+    called with the patcher on install, and should replace attributes through
+    `setattr` and register any other cleanup through `defer`. `install` and
+    `uninstall` are idempotent and serialized, so that they may be called
+    from signal handlers or admin views at runtime.
+    """
+
+    def __init__(self, setup):
+        self.setup = setup
+        self.undo = []
+        self.installed = False
+
+    def install(self):
+        with lock:
+            discard(self)
+            if self.installed:
+                return
+            try:
+                self.setup(self)
+            except Exception:
+                self.restore()
+                raise
+            self.installed = True
+
+    def uninstall(self):
+        with lock:
+            discard(self)
+            if not self.installed:
+                return
+            self.restore()
+            self.installed = False
+
+    def restore(self):
+        while self.undo:
+            self.undo.pop()()
+
+    def setattr(self, target, name, value):
+        # Read from `vars` to restore descriptors as defined, and to delete
+        # rather than shadow attributes inherited from base classes
+        attrs = vars(target)
+        if name in attrs:
+            self.defer(setattr, target, name, attrs[name])
+        else:
+            self.defer(delattr, target, name)
+        setattr(target, name, value)
+
+    def defer(self, func, *args, **kwargs):
+        self.undo.append(functools.partial(func, *args, **kwargs))
+
+
+def register(patcher):
+    """Install `patcher` when the next profiling session starts, so that
+    importing an extension doesn't patch the ORM until detection is used.
+    """
+    with lock:
+        if not patcher.installed and patcher not in pending:
+            pending.append(patcher)
+
+
+def discard(patcher):
+    with lock:
+        if patcher in pending:
+            pending.remove(patcher)
+
+
+def activate():
+    """Install registered patchers. Sessions starting concurrently wait until
+    patching completes; once nothing is pending, return without locking.
+    """
+    if not pending:
+        return
+    with lock:
+        while pending:
+            pending[0].install()
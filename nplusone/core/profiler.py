@@ -1,29 +1,26 @@
 # -*- coding: utf-8 -*-
 
-import six
-
 from nplusone.core import listeners
 from nplusone.core import exceptions
 
 
 class Profiler(object):
 
-    def __init__(self, whitelist=None):
-        self.whitelist = [
-            listeners.Rule(**item)
-            for item in (whitelist or [])
-        ]
+    def __init__(self, whitelist=None, **options):
+        self.whitelist = (
+            whitelist
+            if isinstance(whitelist, listeners.Whitelist)
+            else listeners.Whitelist(whitelist)
+        )
+        self.options = options
 
     def __enter__(self):
-        self.listeners = {}
-        for name, listener_type in six.iteritems(listeners.listeners):
-            self.listeners[name] = listener_type(self)
-            self.listeners[name].setup()
+        self.session = listeners.start(self, **self.options)
 
     def __exit__(self, *exc):
-        for name in six.iterkeys(listeners.listeners):
-            self.listeners.pop(name).teardown()
+        listeners.stop(self.session)
 
     def notify(self, message):
-        if not message.match(self.whitelist):
-            raise exceptions.NPlusOneError(message.message)
+        if message.match(self.whitelist):
+            return False
+        raise exceptions.NPlusOneError(message.message)
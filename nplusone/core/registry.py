@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+
+
+class Registry(object):
+    """Metadata derived from ORM classes, fields, and descriptors, computed by
+    `build` on first lookup and reused after. Entries are keyed by identity,
+    since fields may define equality across models, and hold a reference to
+    their key so that ids aren't reused; keys are expected to live as long as
+    the models that define them.
+    """
+
+    def __init__(self, build):
+        self.build = build
+        self.entries = {}
+
+    def get(self, key, *args):
+        """Look up metadata for `key`, building it from `key` and `args` if
+        missing. Concurrent misses may build the same entry more than once.
+        """
+        try:
+            return self.entries[id(key)][1]
+        except KeyError:
+            value = self.build(key, *args)
+            self.entries[id(key)] = key, value
+            return value
+
+    def clear(self):
+        self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
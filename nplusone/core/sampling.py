@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+
+import time
+import random
+import threading
+from collections import OrderedDict
+
+
+class Sampler(object):
+    """Decide at the start of each request whether to profile it. Requests are
+    profiled with probability `rate`, optionally overridden per endpoint by
+    `rates`. Unsampled requests never start a session and so take the
+    zero-overhead path through the patched ORM methods.
+    """
+
+    by_endpoint = False
+
+    def __init__(self, rate=1.0, rates=None):
+        self.rate = rate
+        self.rates = rates or {}
+        if self.rates:
+            self.by_endpoint = True
+
+    @classmethod
+    def from_config(cls, config, **kwargs):
+        return cls(
+            rate=config.get('NPLUSONE_SAMPLE_RATE', 1.0),
+            rates=config.get('NPLUSONE_SAMPLE_RATES'),
+            **kwargs
+        )
+
+    def get_rate(self, endpoint):
+        return self.rates.get(endpoint, self.rate)
+
+    def sample(self, endpoint=None):
+        """Return the sampling rate if the request should be profiled, else
+        `None`.
+        """
+        rate = self.get_rate(endpoint)
+        if rate >= 1 or random.random() < rate:
+            return rate
+        return None
+
+    def record(self, endpoint, detections):
+        """Record the number of detections in a profiled request."""
+        pass
+
+
+class EndpointState(object):
+
+    __slots__ = ('clean', 'last_detected')
+
+    def __init__(self):
+        self.clean = 0
+        self.last_detected = None
+
+
+class AdaptiveSampler(Sampler):
+    """Sampler that backs off endpoints that stay clean. Each consecutive
+    clean profiled request multiplies the endpoint's sampling rate by `decay`,
+    down to `floor`; a detection resets the endpoint to a rate of 1. State is
+    kept for at most `max_endpoints` endpoints, evicting the oldest first.
+    Pass a shared `endpoints` table to keep state across reconfiguration.
+    """
+
+    by_endpoint = True
+
+    def __init__(self, rate=1.0, rates=None, decay=0.9, floor=0.01,
+                 max_endpoints=1000, endpoints=None):
+        super(AdaptiveSampler, self).__init__(rate=rate, rates=rates)
+        self.decay = decay
+        self.floor = floor
+        self.max_endpoints = max_endpoints
+        self.endpoints = OrderedDict() if endpoints is None else endpoints
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config, **kwargs):
+        return super(AdaptiveSampler, cls).from_config(
+            config,
+            decay=config.get('NPLUSONE_SAMPLE_DECAY', 0.9),
+            floor=config.get('NPLUSONE_SAMPLE_FLOOR', 0.01),
+            **kwargs
+        )
+
+    def get_rate(self, endpoint):
+        rate = super(AdaptiveSampler, self).get_rate(endpoint)
+        state = self.endpoints.get(endpoint)
+        if state is None:
+            return rate
+        if state.last_detected is not None:
+            rate = 1.0
+        return max(rate * self.decay ** state.clean, min(self.floor, rate))
+
+    def record(self, endpoint, detections):
+        with self.lock:
+            state = self.endpoints.get(endpoint)
+            if state is None:
+                state = self.endpoints[endpoint] = EndpointState()
+                while len(self.endpoints) > self.max_endpoints:
+                    self.endpoints.popitem(last=False)
+            if detections:
+                state.clean = 0
+                state.last_detected = time.time()
+            else:
+                state.clean += 1
+
+
+def init(config, endpoints=None):
+    if config.get('NPLUSONE_SAMPLE_ADAPTIVE'):
+        return AdaptiveSampler.from_config(config, endpoints=endpoints)
+    return Sampler.from_config(config)
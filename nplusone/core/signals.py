@@ -1,10 +1,19 @@
 # -*- coding: utf-8 -*-
 
+import types
 import functools
+import threading
 import contextlib
 
 import blinker
 
+from nplusone.core import patching
+
+try:
+    import contextvars
+except ImportError:  # pragma: no cover
+    contextvars = None
+
 
 load = blinker.Signal()
 ignore_load = blinker.Signal()
@@ -12,23 +21,226 @@ lazy_load = blinker.Signal()
 eager_load = blinker.Signal()
 touch = blinker.Signal()
 
+# Signals whose parsers take the return value of the wrapped call
+returning = (load, ignore_load)
+
+
+def parse(signal, args, kwargs, context, ret, parser):
+    """Parse an event into identity keys, materializing keys that parsers
+    compute lazily, so that the result holds no references to ORM instances.
+    """
+    if signal in returning:
+        parsed = parser(args, kwargs, context, ret)
+    else:
+        parsed = parser(args, kwargs, context)
+    if isinstance(parsed, tuple):
+        return tuple(
+            list(item) if isinstance(item, types.GeneratorType) else item
+            for item in parsed
+        )
+    return parsed
+
+
+def parsed(args, kwargs, context, ret=None):
+    """Parser for buffered events, which carry their parsed keys as
+    `context`.
+    """
+    return context
+
+
+class LocalVar(threading.local):
+    """Minimal stand-in for `contextvars.ContextVar` on Python versions that
+    lack the `contextvars` module. Tokens are the previous values.
+    """
+    value = None
+
+    def get(self):
+        return self.value
+
+    def set(self, value):
+        token, self.value = self.value, value
+        return token
+
+    def reset(self, token):
+        self.value = token
+
+
+if contextvars is not None:
+    current = contextvars.ContextVar('nplusone_session', default=None)
+else:  # pragma: no cover
+    current = LocalVar()
+
+
+class Session(object):
+    """Profiling session scoped to the current context (thread, asyncio task,
+    or greenlet). Signals are sent with the active session as sender; patched
+    ORM methods fall straight through to the original implementation when no
+    session is active.
+
+    Receivers and `ignore` scopes are stored on the session rather than in
+    blinker's shared receiver tables, so that starting and ending a session
+    or ignoring a signal never mutates process-global state.
+
+    In deferred mode, events are parsed into identity keys as they are emitted,
+    since ORM instances may be collected or expired before the session ends,
+    and appended to a preallocated buffer of `buffer_size` slots; matching
+    and reporting run on `flush`. Touches are only buffered once an eager
+    load has been, as listeners ignore them before then. When the buffer is
+    full, buffered events are dispatched early to make room, and `spilled`
+    counts these early flushes.
+
+    `max_tracked` caps the number of instances that listeners track exactly;
+    further instances go to Bloom filters sized for `bloom_capacity` keys,
+    or `max_tracked` by default. With `aggregate`, listeners collect repeated
+    detections and report each distinct issue once, with a count, when the
+    session ends.
+    """
+    def __init__(self, endpoint=None, sample_rate=1.0, deferred=False,
+                 buffer_size=10000, max_tracked=None, bloom_capacity=None,
+                 aggregate=False):
+        self.endpoint = endpoint
+        self.sample_rate = sample_rate
+        self.max_tracked = max_tracked
+        self.bloom_capacity = bloom_capacity
+        self.aggregate = aggregate
+        self.detections = 0
+        self.token = None
+        self.listeners = {}
+        self.receivers = {}
+        self.ignored = {}
+        self.buffer = [None] * buffer_size if deferred else None
+        self.buffered = 0
+        self.spilled = 0
+        self.eager = False
+
+    def emit(self, signal, args=None, kwargs=None, context=None, ret=None,
+             parser=None):
+        if self.buffer is None:
+            signal.send(
+                self,
+                args=args,
+                kwargs=kwargs,
+                context=context,
+                ret=ret,
+                parser=parser,
+            )
+            return
+        if self.ignored and self.ignored.get(signal):
+            return
+        if signal is touch and not self.eager:
+            return
+        if signal is eager_load:
+            self.eager = True
+        keys = parse(signal, args, kwargs, context, ret, parser)
+        if self.buffered == len(self.buffer):
+            self.spilled += 1
+            self.flush()
+        if self.buffered < len(self.buffer):
+            self.buffer[self.buffered] = (signal, keys)
+            self.buffered += 1
+        else:
+            signal.send(self, context=keys, parser=parsed)
+
+    def flush(self):
+        """Dispatch buffered events in order. Events emitted while flushing are
+        dispatched immediately.
+        """
+        buffer, size = self.buffer, self.buffered
+        if not size:
+            return
+        self.buffer = None
+        try:
+            for index in range(size):
+                signal, keys = buffer[index]
+                buffer[index] = None
+                signal.send(self, context=keys, parser=parsed)
+        finally:
+            self.buffer = buffer
+            self.buffered = 0
+
+
+class Dispatcher(object):
+    """Receiver permanently connected to a signal that routes each event to
+    the receivers registered on the sending session.
+    """
+    def __init__(self, signal):
+        self.signal = signal
+        signal.connect(self, weak=False)
+
+    def __call__(self, sender, **kwargs):
+        if not isinstance(sender, Session):
+            return
+        if sender.ignored and sender.ignored.get(self.signal):
+            return
+        for receiver in sender.receivers.get(self.signal, ()):
+            receiver(sender, **kwargs)
+
+
+dispatchers = [
+    Dispatcher(signal)
+    for signal in (load, ignore_load, lazy_load, eager_load, touch)
+]
+
+
+def get_session():
+    return current.get()
+
+
+def start_session(**options):
+    # Patch ORMs on first use rather than on import
+    patching.activate()
+    session = Session(**options)
+    session.token = current.set(session)
+    return session
+
+
+def end_session(session):
+    try:
+        current.reset(session.token)
+    except ValueError:
+        # Under ASGI, Django runs middleware hooks in separate copies of the
+        # request context, so the session may end in a context other than the
+        # one that started it; restore the previous session by hand
+        if current.get() is session:
+            previous = session.token.old_value
+            current.set(None if previous is contextvars.Token.MISSING else previous)
+
+
+def connect(signal, receiver):
+    """Connect `receiver` to `signal` for the active session."""
+    receivers = current.get().receivers.setdefault(signal, [])
+    if receiver not in receivers:
+        receivers.append(receiver)
+
+
+def disconnect(signal, receiver):
+    receivers = current.get().receivers.get(signal, [])
+    if receiver in receivers:
+        receivers.remove(receiver)
+
+
+def is_active():
+    return current.get() is not None
+
 
 def get_worker(*args, **kwargs):
-    return blinker.ANY
+    return current.get()
+
+
+def send(signal, **kwargs):
+    session = current.get()
+    if session is not None:
+        session.emit(signal, **kwargs)
 
 
 def signalify(signal, func, parser=None, **context):
     @functools.wraps(func)
     def wrapped(*args, **kwargs):
+        session = current.get()
+        if session is None:
+            return func(*args, **kwargs)
         ret = func(*args, **kwargs)
-        signal.send(
-            get_worker(),
-            args=args,
-            kwargs=kwargs,
-            ret=ret,
-            context=context,
-            parser=parser,
-        )
+        session.emit(signal, args, kwargs, context, ret, parser)
         return ret
     return wrapped
 
@@ -36,19 +248,26 @@ def signalify(signal, func, parser=None, **context):
 def designalify(signal, func):
     @functools.wraps(func)
     def wrapped(*args, **kwargs):
+        if current.get() is None:
+            return func(*args, **kwargs)
         with ignore(signal):
             return func(*args, **kwargs)
     return wrapped
 
 
 @contextlib.contextmanager
-def ignore(signal, sender=None):
-    sender = sender or get_worker()
-    receivers = list(signal.receivers_for(sender))
-    for receiver in receivers:
-        signal.disconnect(receiver, sender=sender)
+def ignore(signal):
+    """Suppress `signal` for the active session. Scopes nest and only affect
+    the current context.
+    """
+    session = current.get()
+    if session is None:
+        yield
+        return
+    session.ignored[signal] = session.ignored.get(signal, 0) + 1
     try:
         yield
     finally:
-        for receiver in receivers:
-            signal.connect(receiver, sender=sender)
+        session.ignored[signal] -= 1
+        if not session.ignored[signal]:
+            del session.ignored[signal]
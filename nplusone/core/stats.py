@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+
+import time
+import weakref
+import threading
+from collections import namedtuple
+
+Stat = namedtuple(
+    'Stat',
+    [
+        'endpoint', 'label', 'model', 'field',
+        'count', 'estimated', 'first_seen', 'last_seen',
+    ],
+)
+
+
+class Entry(object):
+
+    __slots__ = ('count', 'estimated', 'first_seen', 'last_seen')
+
+    def __init__(self, now):
+        self.count = 0
+        self.estimated = 0.0
+        self.first_seen = now
+        self.last_seen = now
+
+    def update(self, other):
+        self.count += other.count
+        self.estimated += other.estimated
+        self.first_seen = min(self.first_seen, other.first_seen)
+        self.last_seen = max(self.last_seen, other.last_seen)
+
+
+def merge(target, shard):
+    for key, entry in list(shard.items()):
+        merged = target.get(key)
+        if merged is None:
+            merged = target[key] = Entry(entry.first_seen)
+        merged.update(entry)
+
+
+class Stats(object):
+    """Process-wide detection counts keyed by `(endpoint, label, model,
+    field)`. Each thread records into its own shard, so that recording takes
+    no lock; `snapshot` merges the shards. Shards of threads that have exited
+    are folded into a single shared shard as new threads start recording.
+    `estimated` sums detections divided by the sampling rate of their
+    requests, extrapolating to all requests.
+
+    Hooks added with `add_hook` are called with a snapshot by `flush`, and by
+    `tick` once `interval` seconds have passed since the last flush.
+    Integrations call `tick` as each profiling session ends.
+    """
+
+    def __init__(self, interval=60):
+        self.interval = interval
+        self.local = threading.local()
+        # Pairs of weak references to live threads and their shards
+        self.shards = []
+        self.retired = {}
+        self.hooks = []
+        self.lock = threading.Lock()
+        self.flushed = time.time()
+
+    def get_shard(self):
+        try:
+            return self.local.shard
+        except AttributeError:
+            shard = self.local.shard = {}
+            with self.lock:
+                self.prune()
+                self.shards.append((weakref.ref(threading.current_thread()), shard))
+            return shard
+
+    def prune(self):
+        """Fold the shards of exited threads into `retired`. Call with the
+        lock held.
+        """
+        live = []
+        for ref, shard in self.shards:
+            thread = ref()
+            if thread is not None and thread.is_alive():
+                live.append((ref, shard))
+            else:
+                merge(self.retired, shard)
+        self.shards = live
+
+    def record(self, endpoint, label, model, field, sample_rate=1.0, count=1):
+        now = time.time()
+        shard = self.get_shard()
+        key = (endpoint, label, model, field)
+        entry = shard.get(key)
+        if entry is None:
+            entry = shard[key] = Entry(now)
+        entry.count += count
+        entry.estimated += float(count) / sample_rate
+        entry.last_seen = now
+
+    def snapshot(self):
+        """Merge counts across threads, ordered by count, highest first."""
+        merged = {}
+        with self.lock:
+            self.prune()
+            merge(merged, self.retired)
+            shards = [shard for _, shard in self.shards]
+        for shard in shards:
+            merge(merged, shard)
+        return sorted(
+            (
+                Stat(*(key + (
+                    entry.count, entry.estimated,
+                    entry.first_seen, entry.last_seen,
+                )))
+                for key, entry in merged.items()
+            ),
+            key=lambda stat: stat.count,
+            reverse=True,
+        )
+
+    def reset(self):
+        with self.lock:
+            self.retired.clear()
+            for _, shard in self.shards:
+                shard.clear()
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    def flush(self):
+        self.flushed = time.time()
+        if not self.hooks:
+            return
+        snapshot = self.snapshot()
+        for hook in list(self.hooks):
+            hook(snapshot)
+
+    def tick(self):
+        """Flush if `interval` seconds have passed since the last flush."""
+        if not self.interval or time.time() - self.flushed < self.interval:
+            return
+        with self.lock:
+            if time.time() - self.flushed < self.interval:
+                return
+            self.flushed = time.time()
+        self.flush()
+
+
+registry = Stats()
+
+record = registry.record
+snapshot = registry.snapshot
+reset = registry.reset
+add_hook = registry.add_hook
+remove_hook = registry.remove_hook
+flush = registry.flush
+tick = registry.tick
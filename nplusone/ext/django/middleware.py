@@ -1,63 +1,99 @@
 # -*- coding: utf-8 -*-
 
-import fnmatch
 import weakref
-
-import six
+from collections import OrderedDict
 
 from django.conf import settings
+from django.core.signals import setting_changed
 
 try:
     from django.utils.deprecation import MiddlewareMixin
 except ImportError:
     MiddlewareMixin = object
 
+try:
+    from django.urls import resolve, Resolver404
+except ImportError:  # pragma: no cover
+    from django.core.urlresolvers import resolve, Resolver404
+
 from nplusone.core import listeners
+from nplusone.core import sampling
 from nplusone.core import notifiers
 
 
 class DjangoRule(listeners.Rule):
 
-    def match_model(self, model):
-        return (
-            self.model is model or (
-                isinstance(self.model, six.string_types) and
-                fnmatch.fnmatch(
-                    '{0}.{1}'.format(model._meta.app_label, model.__name__),
-                    self.model,
-                )
-            )
-        )
+    @staticmethod
+    def model_name(model):
+        return '{0}.{1}'.format(model._meta.app_label, model.__name__)
 
 
 class NPlusOneMiddleware(MiddlewareMixin):
 
     def __init__(self, *args, **kwargs):
         super(NPlusOneMiddleware, self).__init__(*args, **kwargs)
-        self.listeners = weakref.WeakKeyDictionary()
+        self.sessions = weakref.WeakKeyDictionary()
+        self.endpoints = OrderedDict()
+        self.loaded = False
+        setting_changed.connect(self.setting_changed)
+
+    def get_config(self):
+        # Read through `settings` rather than `vars(settings._wrapped)` so
+        # that overridden settings fall back to those configured
+        return {
+            key: getattr(settings, key)
+            for key in dir(settings)
+            if key.startswith('NPLUSONE_')
+        }
 
     def load_config(self):
-        self.notifiers = notifiers.init(vars(settings._wrapped))
-        self.whitelist = [
-            DjangoRule(**item)
-            for item in getattr(settings, 'NPLUSONE_WHITELIST', [])
-        ]
+        config = self.get_config()
+        self.notifiers = notifiers.init(config)
+        self.whitelist = listeners.Whitelist(
+            config.get('NPLUSONE_WHITELIST', []),
+            rule=DjangoRule,
+        )
+        self.sampler = sampling.init(config, endpoints=self.endpoints)
+        self.options = listeners.get_options(config)
+        self.loaded = True
+
+    def setting_changed(self, setting, **kwargs):
+        if setting.startswith('NPLUSONE_'):
+            self.loaded = False
+
+    def get_endpoint(self, request):
+        try:
+            return resolve(request.path_info, getattr(request, 'urlconf', None)).view_name
+        except Resolver404:
+            return request.path_info
 
     def process_request(self, request):
-        self.load_config()
-        self.listeners[request] = self.listeners.get(request, {})
-        for name, listener_type in six.iteritems(listeners.listeners):
-            self.listeners[request][name] = listener_type(self)
-            self.listeners[request][name].setup()
+        if not self.loaded:
+            self.load_config()
+        endpoint = self.get_endpoint(request) if self.sampler.by_endpoint else None
+        rate = self.sampler.sample(endpoint)
+        if rate:
+            # Resolve the endpoint of profiled requests for reporting, even if
+            # sampling doesn't depend on it
+            if endpoint is None:
+                endpoint = self.get_endpoint(request)
+            self.sessions[request] = listeners.start(
+                self,
+                endpoint=endpoint,
+                sample_rate=rate,
+                **self.options
+            )
 
     def process_response(self, request, response):
-        for name, listener_type in six.iteritems(listeners.listeners):
-            listener = self.listeners.get(request, {}).pop(name, None)
-            if listener:
-                listener.teardown()
+        session = self.sessions.pop(request, None)
+        if session:
+            listeners.stop(session)
+            self.sampler.record(session.endpoint, session.detections)
         return response
 
     def notify(self, message):
-        if not message.match(self.whitelist):
-            for notifier in self.notifiers:
-                notifier.notify(message)
+        if message.match(self.whitelist):
+            return False
+        for notifier in self.notifiers:
+            notifier.notify(message)
+        return True
@@ -4,13 +4,15 @@ import copy
 import inspect
 import functools
 import importlib
-import threading
 
 import django
+from django.apps import apps
 from django.db.models import query
 from django.db.models import Model
 
 from nplusone.core import signals
+from nplusone.core import patching
+from nplusone.core import registry
 
 if django.VERSION >= (1, 9):  # pragma: no cover
     from django.db.models.fields.related_descriptors import (
@@ -28,29 +30,24 @@ else:  # pragma: no cover
     )
 
 
-def get_worker():
-    return str(threading.current_thread().ident)
-
-
-def setup_state():
-    signals.get_worker = get_worker
-setup_state()
-
-
 def to_key(instance):
-    model = type(instance)
-    return ':'.join([model.__name__, format(instance.pk)])
+    return type(instance), instance.pk
 
 
-def patch(original, patched):
-    module = importlib.import_module(original.__module__)
-    setattr(module, original.__name__, patched)
+def iter_keys(instances):
+    """Compute identity keys lazily. Touch parsers return these so that keys
+    are only computed for associations that were eager loaded.
+    """
+    for instance in instances:
+        yield to_key(instance)
 
 
 def signalify_queryset(func, parser=None, **context):
     @functools.wraps(func)
     def wrapped(*args, **kwargs):
         queryset = func(*args, **kwargs)
+        if not signals.is_active():
+            return queryset
         ctx = copy.copy(context)
         ctx['args'] = context.get('args', args)
         ctx['kwargs'] = context.get('kwargs', kwargs)
@@ -70,8 +67,8 @@ def signalify_fetch_all(queryset, parser=None, **context):
     @functools.wraps(func)
     def wrapped(*args, **kwargs):
         if queryset._result_cache is None:
-            signals.lazy_load.send(
-                get_worker(),
+            signals.send(
+                signals.lazy_load,
                 args=args,
                 kwargs=kwargs,
                 ret=None,
@@ -101,6 +98,10 @@ def parse_field(field):
     )
 
 
+# Resolved `(model, name)` pairs per relation field
+field_names = registry.Registry(parse_field)
+
+
 def parse_reverse_field(field):
     return field.model, field.name
 
@@ -124,10 +125,19 @@ def parse_related_parts(model, related_name, related_model):
     )
 
 
+def get_related_key(context):
+    return context['rel'] if 'rel' in context else context['rel_field']
+
+
+# Resolved `(model, name)` pairs per one-to-many relation. Note: key by the
+# relation rather than the manager class, since managers built by
+# `RelatedManager.__call__` get a new class on each call
+related_names = registry.Registry(lambda rel, context: parse_related(context))
+
+
 def parse_reverse_one_to_one_queryset(args, kwargs, context):
     descriptor = context['args'][0]
-    field = descriptor.related.field
-    model, name = parse_field(field)
+    model, name = field_names.get(descriptor.related.field)
     instance = context['kwargs']['instance']
     return model, to_key(instance), name
 
@@ -138,33 +148,34 @@ def parse_forward_many_to_one_queryset(args, kwargs, context):
     return descriptor.field.model, to_key(instance), descriptor.field.name
 
 
-def parse_many_related_queryset(args, kwargs, context):
-    rel = context['rel']
-    manager = context['args'][0]
-    model = manager.instance.__class__
+def parse_many_related_name(target_field, manager, rel):
     related_model = (
         manager.target_field.related_model  # Django >= 1.8
         if hasattr(manager.target_field, 'related_model')
         else manager.target_field.related_field.model  # Django <= 1.8
     )
     field = manager.prefetch_cache_name if rel.related_name else None
+    return field or get_related_name(related_model)
+
+
+# Resolved names per many-to-many relation and direction, keyed by the field
+# of the intermediate model that refers to the related model
+many_related_names = registry.Registry(parse_many_related_name)
+
+
+def parse_many_related_queryset(args, kwargs, context):
+    manager = context['args'][0]
     return (
-        model,
+        manager.instance.__class__,
         to_key(manager.instance),
-        field or get_related_name(related_model),
+        many_related_names.get(manager.target_field, manager, context['rel']),
     )
 
 
 def parse_foreign_related_queryset(args, kwargs, context):
-    model, name = parse_related(context)
-    descriptor = context['args'][0]
-    return model, to_key(descriptor.instance), name
-
-
-query.prefetch_one_level = signals.designalify(
-    signals.lazy_load,
-    query.prefetch_one_level,
-)
+    manager = context['args'][0]
+    model, name = related_names.get(get_related_key(context), context)
+    return model, to_key(manager.instance), name
 
 
 def parse_get(args, kwargs, context, ret):
@@ -172,18 +183,18 @@ def parse_get(args, kwargs, context, ret):
 
 
 # Ignore records loaded during `get`
-query.QuerySet.get = signals.signalify(
+queryset_get = signals.signalify(
     signals.ignore_load,
     query.QuerySet.get,
     parser=parse_get,
 )
 
 
-ReverseOneToOneDescriptor.get_queryset = signalify_queryset(
+reverse_one_to_one_get_queryset = signalify_queryset(
     ReverseOneToOneDescriptor.get_queryset,
     parser=parse_reverse_one_to_one_queryset,
 )
-ForwardManyToOneDescriptor.get_queryset = signalify_queryset(
+forward_many_to_one_get_queryset = signalify_queryset(
     ForwardManyToOneDescriptor.get_queryset,
     parser=parse_forward_many_to_one_queryset,
 )
@@ -198,7 +209,6 @@ def _create_forward_many_to_many_manager(*args, **kwargs):
         **context
     )
     return manager
-patch(create_forward_many_to_many_manager, _create_forward_many_to_many_manager)
 
 
 def _create_reverse_many_to_one_manager(*args, **kwargs):
@@ -211,7 +221,6 @@ def _create_reverse_many_to_one_manager(*args, **kwargs):
         **context
     )
     return manager
-patch(create_reverse_many_to_one_manager, _create_reverse_many_to_one_manager)
 
 
 def parse_forward_many_to_one_get(args, kwargs, context):
@@ -219,10 +228,10 @@ def parse_forward_many_to_one_get(args, kwargs, context):
     if instance is None:
         return None
     field, model = parse_reverse_field(descriptor.field)
-    return field, model, [to_key(instance)]
+    return field, model, iter_keys([instance])
 
 
-ForwardManyToOneDescriptor.__get__ = signals.signalify(
+forward_many_to_one_get = signals.signalify(
     signals.touch,
     ForwardManyToOneDescriptor.__get__,
     parser=parse_forward_many_to_one_get,
@@ -233,11 +242,11 @@ def parse_reverse_one_to_one_get(args, kwargs, context):
     descriptor, instance = args[:2]
     if instance is None:
         return None
-    model, field = parse_field(descriptor.related.field)
-    return model, field, [to_key(instance)]
+    model, field = field_names.get(descriptor.related.field)
+    return model, field, iter_keys([instance])
 
 
-ReverseOneToOneDescriptor.__get__ = signals.signalify(
+reverse_one_to_one_get = signals.signalify(
     signals.touch,
     ReverseOneToOneDescriptor.__get__,
     parser=parse_reverse_one_to_one_get,
@@ -253,13 +262,20 @@ def parse_fetch_all(args, kwargs, context):
         if manager.__class__.__name__ == 'ManyRelatedManager':
             return (
                 instance.__class__,
-                parse_manager_field(manager, self._context['rel']),
-                [to_key(instance)],
+                manager_names.get(
+                    manager.target_field,
+                    manager,
+                    self._context['rel'],
+                ),
+                iter_keys([instance]),
             )
         # Handle iteration over one-to-many relationship
         else:
-            model, field = parse_related(self._context)
-            return model, field, [to_key(instance)]
+            model, field = related_names.get(
+                get_related_key(self._context),
+                self._context,
+            )
+            return model, field, iter_keys([instance])
 
 
 def parse_manager_field(manager, rel):
@@ -268,6 +284,13 @@ def parse_manager_field(manager, rel):
     return rel.field.name or get_related_name(rel.model)
 
 
+# Resolved field names per many-to-many relation and direction, keyed as
+# `many_related_names`
+manager_names = registry.Registry(
+    lambda target_field, manager, rel: parse_manager_field(manager, rel),
+)
+
+
 def parse_load(args, kwargs, context, ret):
     return [
         to_key(row)
@@ -286,9 +309,11 @@ def is_single(low, high):
 # in Django templates, which does not call `__iter__`.
 original_fetch_all = query.QuerySet._fetch_all
 def fetch_all(self):
+    if not signals.is_active():
+        return original_fetch_all(self)
     if self._prefetch_done:
-        signals.touch.send(
-            get_worker(),
+        signals.send(
+            signals.touch,
             args=(self, ),
             parser=parse_fetch_all,
         )
@@ -298,13 +323,12 @@ def fetch_all(self):
         if is_single(self.query.low_mark, self.query.high_mark)
         else signals.load
     )
-    signal.send(
-        get_worker(),
+    signals.send(
+        signal,
         args=(self, ),
         ret=self._result_cache,
         parser=parse_load,
     )
-query.QuerySet._fetch_all = fetch_all
 
 
 original_related_populator_init = query.RelatedPopulator.__init__
@@ -314,7 +338,6 @@ def related_populator_init(self, *args, **kwargs):
         'args': args,
         'kwargs': kwargs,
     }
-query.RelatedPopulator.__init__ = related_populator_init
 
 
 def parse_eager_select(args, kwargs, context):
@@ -324,7 +347,7 @@ def parse_eager_select(args, kwargs, context):
     klass_info, select, _ = meta['args']
     field = klass_info['field']
     model, name = (
-        parse_field(field)
+        field_names.get(field)
         if instance._meta.model != field.model
         else parse_reverse_field(field)
     )
@@ -332,7 +355,7 @@ def parse_eager_select(args, kwargs, context):
 
 
 # Emit `eager_load` on populating from `select_related`
-query.RelatedPopulator.populate = signals.signalify(
+related_populator_populate = signals.signalify(
     signals.eager_load,
     query.RelatedPopulator.populate,
     parser=parse_eager_select,
@@ -347,10 +370,11 @@ def parse_eager_join(args, kwargs, context):
     return model, field, keys, id(instances)
 
 
-# Emit `eager_load` on populating from `prefetch_related`
-query.prefetch_one_level = signals.signalify(
+# Emit `eager_load` on populating from `prefetch_related`, and ignore lazy
+# loads issued while prefetching
+prefetch_one_level = signals.signalify(
     signals.eager_load,
-    query.prefetch_one_level,
+    signals.designalify(signals.lazy_load, query.prefetch_one_level),
     parser=parse_eager_join,
 )
 
@@ -359,10 +383,78 @@ query.prefetch_one_level = signals.signalify(
 original_getitem_queryset = query.QuerySet.__getitem__
 def getitem_queryset(self, index):
     if self._prefetch_done:
-        signals.touch.send(
-            get_worker(),
+        signals.send(
+            signals.touch,
             args=(self, ),
             parser=parse_fetch_all,
         )
     return original_getitem_queryset(self, index)
-query.QuerySet.__getitem__ = getitem_queryset
+
+
+def get_module(func):
+    return importlib.import_module(func.__module__)
+
+
+def clear_related_managers():
+    """Drop related manager classes cached on relation descriptors, so that
+    they are rebuilt from the current manager factories.
+    """
+    if not apps.models_ready:
+        return
+    for model in apps.get_models(include_auto_created=True):
+        for value in vars(model).values():
+            if 'related_manager_cls' in getattr(value, '__dict__', ()):
+                del value.__dict__['related_manager_cls']
+
+
+def setup(patcher):
+    patcher.setattr(query, 'prefetch_one_level', prefetch_one_level)
+    patcher.setattr(query.QuerySet, 'get', queryset_get)
+    patcher.setattr(query.QuerySet, '_fetch_all', fetch_all)
+    patcher.setattr(query.QuerySet, '__getitem__', getitem_queryset)
+    patcher.setattr(query.RelatedPopulator, '__init__', related_populator_init)
+    patcher.setattr(query.RelatedPopulator, 'populate', related_populator_populate)
+    patcher.setattr(
+        ReverseOneToOneDescriptor,
+        'get_queryset',
+        reverse_one_to_one_get_queryset,
+    )
+    patcher.setattr(
+        ForwardManyToOneDescriptor,
+        'get_queryset',
+        forward_many_to_one_get_queryset,
+    )
+    patcher.setattr(ReverseOneToOneDescriptor, '__get__', reverse_one_to_one_get)
+    patcher.setattr(ForwardManyToOneDescriptor, '__get__', forward_many_to_one_get)
+    patcher.setattr(
+        get_module(create_forward_many_to_many_manager),
+        create_forward_many_to_many_manager.__name__,
+        _create_forward_many_to_many_manager,
+    )
+    patcher.setattr(
+        get_module(create_reverse_many_to_one_manager),
+        create_reverse_many_to_one_manager.__name__,
+        _create_reverse_many_to_one_manager,
+    )
+    # Related managers are built once per descriptor and cached, so rebuild
+    # them on installing and again on uninstalling
+    clear_related_managers()
+    patcher.defer(clear_related_managers)
+
+
+patcher = patching.Patcher(setup)
+
+
+def install():
+    """Patch Django to emit nplusone signals. Called when the first profiling
+    session starts after import.
+    """
+    patcher.install()
+
+
+def uninstall():
+    """Restore the methods and functions replaced by `install`."""
+    patcher.uninstall()
+
+
+patching.register(patcher)
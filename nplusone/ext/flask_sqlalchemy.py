@@ -1,26 +1,30 @@
 # -*- coding: utf-8 -*-
 
-import six
+from collections import OrderedDict
 
 from flask import g
+from flask import current_app
 from flask import request
 
 from nplusone.core import signals
 from nplusone.core import listeners
+from nplusone.core import sampling
 from nplusone.core import notifiers
 import nplusone.ext.sqlalchemy  # noqa
 
 
-def get_worker():
-    try:
-        return request._get_current_object()
-    except RuntimeError:
-        return None
+class State(object):
+    """Notifiers, whitelist, sampler, and session options built from the
+    config of an app. Sampler state is kept in `endpoints`, which persists
+    across reloads.
+    """
 
-
-def setup_state():
-    signals.get_worker = get_worker
-setup_state()
+    def __init__(self, config, endpoints=None):
+        self.endpoints = OrderedDict() if endpoints is None else endpoints
+        self.notifiers = notifiers.init(config)
+        self.whitelist = listeners.Whitelist(config.get('NPLUSONE_WHITELIST', []))
+        self.sampler = sampling.init(config, endpoints=self.endpoints)
+        self.options = listeners.get_options(config)
 
 
 class NPlusOne(object):
@@ -30,33 +34,59 @@ class NPlusOne(object):
             self.init_app(app)
 
     def load_config(self, app):
-        self.notifiers = notifiers.init(app.config)
-        self.whitelist = [
-            listeners.Rule(**item)
-            for item in app.config.get('NPLUSONE_WHITELIST', [])
-        ]
+        """Build notifiers, whitelist, and sampler from `app.config` and store
+        them in `app.extensions`. Called on the first request to each app;
+        call again to apply later changes to the config.
+        """
+        previous = app.extensions.get('nplusone')
+        state = app.extensions['nplusone'] = State(
+            app.config,
+            endpoints=previous.endpoints if previous else None,
+        )
+        return state
+
+    def get_state(self, app):
+        state = app.extensions.get('nplusone')
+        return self.load_config(app) if state is None else state
 
     def init_app(self, app):
         @app.before_request
         def connect():
-            self.load_config(app)
-            g.listeners = getattr(g, 'listeners', {})
-            for name, listener_type in six.iteritems(listeners.listeners):
-                g.listeners[name] = listener_type(self)
-                g.listeners[name].setup()
+            state = self.get_state(app)
+            rate = state.sampler.sample(request.endpoint)
+            if rate:
+                g.nplusone = listeners.start(
+                    self,
+                    endpoint=request.endpoint,
+                    sample_rate=rate,
+                    **state.options
+                )
 
         @app.after_request
         def disconnect(response):
-            for name in six.iterkeys(listeners.listeners):
-                listener = g.listeners.pop(name, None)
-                if listener:
-                    listener.teardown()
+            session = g.pop('nplusone', None)
+            if session:
+                listeners.stop(session)
+                self.get_state(app).sampler.record(
+                    session.endpoint,
+                    session.detections,
+                )
             return response
 
+        @app.teardown_request
+        def teardown(exc=None):
+            # End sessions left open when `after_request` handlers are skipped
+            session = g.pop('nplusone', None)
+            if session:
+                signals.end_session(session)
+
     def notify(self, message):
-        if not message.match(self.whitelist):
-            for notifier in self.notifiers:
-                notifier.notify(message)
+        state = self.get_state(current_app)
+        if message.match(state.whitelist):
+            return False
+        for notifier in state.notifiers:
+            notifier.notify(message)
+        return True
 
     def ignore(self, signal):
         return signals.ignore(getattr(signals, signal))
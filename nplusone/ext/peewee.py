@@ -11,6 +11,7 @@ from peewee import BaseModelSelect
 from peewee import database_required
 
 from nplusone.core import signals
+from nplusone.core import patching
 
 
 def parse_get_object(args, kwargs, context):
@@ -27,8 +28,8 @@ def get_rel_instance(self, instance):
     value = instance.__data__.get(self.name)
     if value is not None or self.name in instance.__rel__:
         if self.name not in instance.__rel__:
-            signals.lazy_load.send(
-                signals.get_worker(),
+            signals.send(
+                signals.lazy_load,
                 args=(self, instance),
                 parser=parse_get_object,
             )
@@ -38,7 +39,6 @@ def get_rel_instance(self, instance):
     elif not self.field.null:
         raise self.rel_model.DoesNotExist
     return value
-ForeignKeyAccessor.get_rel_instance = get_rel_instance
 
 
 def backref_get(self, instance, instance_type=None):
@@ -55,12 +55,10 @@ def backref_get(self, instance, instance_type=None):
         }
         return query
     return self  # pragma: no cover; pasted from peewee
-BackrefAccessor.__get__ = backref_get
 
 
 def to_key(instance):
-    model = type(instance)
-    return ':'.join([model.__name__, format(instance.get_id())])
+    return type(instance), instance.get_id()
 
 
 def parse_load(args, kwargs, context, ret):
@@ -74,22 +72,23 @@ def is_single(offset, limit):
 original_model_select_iter = BaseModelSelect.__iter__
 def model_select_iter(self):
     if isinstance(self, ManyToManyQuery):
-        signals.lazy_load.send(
-            signals.get_worker(),
+        signals.send(
+            signals.lazy_load,
             args=(self._accessor, self._instance),
             parser=parse_get_object,
         )
     return original_model_select_iter(self)
-BaseModelSelect.__iter__ = model_select_iter
 
 
 original_query_execute = BaseQuery.execute
 def query_execute(self, database):
     ret = original_query_execute(self, database)
+    if not signals.is_active():
+        return ret
     if hasattr(self, '_context'):
         # Query has been marked as lazy during backref lookup
-        signals.lazy_load.send(
-            signals.get_worker(),
+        signals.send(
+            signals.lazy_load,
             args=self._context['args'],
             kwargs=self._context['kwargs'],
             parser=parse_reverse_get,
@@ -101,11 +100,35 @@ def query_execute(self, database):
         if is_single(self._offset, self._limit)
         else signals.load
     )
-    signal.send(
-        signals.get_worker(),
+    signals.send(
+        signal,
         args=(self, ),
         ret=list(ret),
         parser=parse_load,
     )
     return ret
-BaseQuery.execute = database_required(query_execute)
+
+
+def setup(patcher):
+    patcher.setattr(ForeignKeyAccessor, 'get_rel_instance', get_rel_instance)
+    patcher.setattr(BackrefAccessor, '__get__', backref_get)
+    patcher.setattr(BaseModelSelect, '__iter__', model_select_iter)
+    patcher.setattr(BaseQuery, 'execute', database_required(query_execute))
+
+
+patcher = patching.Patcher(setup)
+
+
+def install():
+    """Patch peewee to emit nplusone signals. Called when the first profiling
+    session starts after import.
+    """
+    patcher.install()
+
+
+def uninstall():
+    """Restore the methods replaced by `install`."""
+    patcher.uninstall()
+
+
+patching.register(patcher)
@@ -2,26 +2,44 @@
 
 from __future__ import absolute_import
 
+import weakref
 import inspect
 import itertools
+import collections
 
+from sqlalchemy import exc
+from sqlalchemy import event
 from sqlalchemy.orm import query
+from sqlalchemy.orm import Mapper
+from sqlalchemy.orm import mapperlib
 from sqlalchemy.orm import loading
 from sqlalchemy.orm import attributes
 from sqlalchemy.orm import strategies
 
+try:
+    from sqlalchemy.engine.result import Result
+    from sqlalchemy.engine.result import ScalarResult
+    from sqlalchemy.engine.result import ChunkedIteratorResult
+except ImportError:  # SQLAlchemy < 1.4
+    ChunkedIteratorResult = None
+
 from nplusone.core import signals
+from nplusone.core import patching
+from nplusone.core import registry
 
 
 def to_key(instance):
     model = type(instance)
-    return ':'.join(
-        [model.__name__] +
-        [
-            format(instance.__dict__.get(key.key))  # Avoid recursion on __get__
-            for key in get_primary_keys(model)
-        ]
-    )
+    # Read from `__dict__` to avoid recursion on `__get__`
+    return model, primary_keys.get(model)(instance.__dict__)
+
+
+def iter_keys(instances):
+    """Compute identity keys lazily. Touch parsers return these so that keys
+    are only computed for associations that were eager loaded.
+    """
+    for instance in instances:
+        yield to_key(instance)
 
 
 def get_primary_keys(model):
@@ -32,6 +50,20 @@ def get_primary_keys(model):
     ]
 
 
+def get_primary_key_getter(model):
+    """Build a function reading the primary key of `model` from the
+    `__dict__` of an instance.
+    """
+    names = [prop.key for prop in get_primary_keys(model)]
+    if len(names) == 1:
+        name = names[0]
+        return lambda values: values.get(name)
+    return lambda values: tuple(values.get(name) for name in names)
+
+
+primary_keys = registry.Registry(get_primary_key_getter)
+
+
 def parse_load(args, kwargs, context, ret):
     return [
         to_key(row) for row in ret
@@ -40,7 +72,7 @@ def parse_load(args, kwargs, context, ret):
 
 
 def parse_lazy_load(args, kwargs, context):
-    loader, state, _ = args
+    loader, state = args[:2]
     return state.object.__class__, to_key(state.object), loader.parent_property.key
 
 
@@ -48,79 +80,364 @@ def parse_attribute_get(args, kwargs, context):
     attr, instance = args[:2]
     if instance is None:
         return None
-    return attr.class_, attr.key, [to_key(instance)]
+    return attr.class_, attr.key, iter_keys([instance])
 
 
-strategies.LazyLoader._load_for_state = signals.signalify(
+load_for_state = signals.signalify(
     signals.lazy_load,
     strategies.LazyLoader._load_for_state,
     parser=parse_lazy_load,
 )
 
 
+query_keys = itertools.count()
+
+
+def get_query_key(query_context):
+    """Key eager loads by the query that populated them. Keys are stored on the
+    query context, since `id` values may be reused once contexts are collected.
+    """
+    attributes = query_context.attributes
+    key = attributes.get('nplusone_query_key')
+    if key is None:
+        key = attributes['nplusone_query_key'] = next(query_keys)
+    return key
+
+
 def parse_populate(args, kwargs, context):
     query_context = args[0]
     state = args[2]
     instance = state.object
-    return instance.__class__, context['key'], [to_key(instance)], id(query_context)
+    return (
+        instance.__class__,
+        context['key'],
+        [to_key(instance)],
+        get_query_key(query_context),
+    )
+
 
+def get_arg_index(func, name):
+    getargspec = getattr(inspect, 'getfullargspec', None) or inspect.getargspec
+    return getargspec(func).args.index(name)
 
-# Emit `eager_load` on populating from `joinedload` or `subqueryload`
+
+def get_arg(args, kwargs, index, name):
+    return args[index] if index < len(args) else kwargs[name]
+
+
+# Emit `eager_load` on populating from `joinedload` or `subqueryload`. Note:
+# the signature of `_populate_full` varies across SQLAlchemy versions, so we
+# resolve argument positions once rather than binding arguments on every row.
 original_populate_full = loading._populate_full
+POPULATORS_INDEX = get_arg_index(original_populate_full, 'populators')
+DICT_INDEX = get_arg_index(original_populate_full, 'dict_')
 def _populate_full(*args, **kwargs):
     ret = original_populate_full(*args, **kwargs)
-    context = inspect.getcallargs(original_populate_full, *args, **kwargs)
-    for key, _ in context['populators'].get('eager', []):
-        if context['dict_'].get(key):
-            signals.eager_load.send(
-                signals.get_worker(),
+    if not signals.is_active():
+        return ret
+    populators = get_arg(args, kwargs, POPULATORS_INDEX, 'populators')
+    dict_ = get_arg(args, kwargs, DICT_INDEX, 'dict_')
+    for key, _ in populators.get('eager', []):
+        if dict_.get(key):
+            signals.send(
+                signals.eager_load,
                 args=args,
                 kwargs=kwargs,
                 context={'key': key},
                 parser=parse_populate,
             )
     return ret
-loading._populate_full = _populate_full
 
 
-attributes.InstrumentedAttribute.__get__ = signals.signalify(
-    signals.touch,
-    attributes.InstrumentedAttribute.__get__,
-    parser=parse_attribute_get,
-)
+def parse_load_for_path(args, kwargs, context):
+    return (
+        context['model'],
+        context['key'],
+        iter_keys(context['instances']),
+        context['query'],
+    )
+
+
+# Emit `eager_load` on populating from `selectinload`, which loads each
+# relationship in a separate query once parent rows are loaded rather than
+# through `_populate_full`. Results are grouped by the parent query, as with
+# `joinedload`, so that unused round trips are reported.
+original_load_for_path = strategies.SelectInLoader._load_for_path
+CONTEXT_INDEX = get_arg_index(original_load_for_path, 'context')
+STATES_INDEX = get_arg_index(original_load_for_path, 'states')
+def _load_for_path(*args, **kwargs):
+    if not signals.is_active():
+        return original_load_for_path(*args, **kwargs)
+    loader = args[0]
+    # Skip parents whose relationship was already loaded
+    states = [
+        state
+        for state, overwrite in get_arg(args, kwargs, STATES_INDEX, 'states')
+        if overwrite or loader.key not in state.dict
+    ]
+    ret = original_load_for_path(*args, **kwargs)
+    query_context = get_arg(args, kwargs, CONTEXT_INDEX, 'context')
+    loaded = collections.defaultdict(list)
+    for state in states:
+        if state.dict.get(loader.key):
+            instance = state.obj()
+            loaded[type(instance)].append(instance)
+    for model, instances in loaded.items():
+        signals.send(
+            signals.eager_load,
+            args=args,
+            kwargs=kwargs,
+            context={
+                'model': model,
+                'key': loader.key,
+                'instances': instances,
+                'query': get_query_key(query_context),
+            },
+            parser=parse_load_for_path,
+        )
+    return ret
+
+
+class RelationshipAttribute(attributes.InstrumentedAttribute):
+    """Instrumented attribute that emits `touch` on access. Installed only on
+    relationship properties, so that column reads keep their native speed.
+    """
+    __slots__ = ()
+
+    def __get__(self, instance, owner):
+        session = signals.current.get()
+        ret = super(RelationshipAttribute, self).__get__(instance, owner)
+        if session is not None:
+            session.emit(signals.touch, (self, instance, owner), {}, {}, ret,
+                         parse_attribute_get)
+        return ret
+
+
+mappers = weakref.WeakSet()
+
+
+def instrument_relationships(mapper, source, target):
+    for prop in mapper.relationships:
+        attr = mapper.class_manager.get(prop.key)
+        if attr is None:
+            continue
+        if type(attr) is source:
+            attr.__class__ = target
+        # Attributes hold lazy loaders bound as mappers are configured, so
+        # rebind them to the current `_load_for_state`
+        loader = getattr(attr.impl.callable_, '__self__', None)
+        if isinstance(loader, strategies.LazyLoader):
+            attr.impl.callable_ = loader._load_for_state
+
+
+def mapper_configured(mapper, class_):
+    mappers.add(mapper)
+
+
+# Backrefs may add relationships to mappers configured earlier, so revisit all
+# known mappers once each configuration pass completes
+def after_configured():
+    for mapper in list(mappers):
+        instrument_relationships(
+            mapper,
+            attributes.InstrumentedAttribute,
+            RelationshipAttribute,
+        )
+
+
+def uninstrument():
+    for mapper in get_mappers():
+        instrument_relationships(
+            mapper,
+            RelationshipAttribute,
+            attributes.InstrumentedAttribute,
+        )
+    mappers.clear()
+
+
+def get_mappers():
+    mapper_registry = getattr(mapperlib, '_mapper_registry', None)
+    if mapper_registry is not None:
+        return list(mapper_registry)
+    # SQLAlchemy 1.4 tracks mappers per declarative registry
+    return [
+        mapper
+        for declarative in mapperlib._all_registries()
+        for mapper in declarative.mappers
+    ]
 
 
 def is_single(offset, limit):
     return limit is not None and limit - (offset or 0) == 1
 
 
+# Number of rows to record per `load` signal when iterating queries that don't
+# set `yield_per`
+CHUNK_SIZE = 100
+
+
+def iter_loaded(rows, signal, query, size):
+    """Record rows as loaded in chunks of `size` as they are iterated. Each
+    chunk is recorded before any of its rows are yielded, so that lazy loads
+    on yielded rows are always detected.
+    """
+    while True:
+        chunk = list(itertools.islice(rows, size))
+        if not chunk:
+            return
+        signals.send(
+            signal,
+            args=(query, ),
+            ret=chunk,
+            parser=parse_load,
+        )
+        for row in chunk:
+            yield row
+
+
+# Emit `load` or `ignore_load` as query results are iterated. Note: results
+# are tracked incrementally rather than materialized up front, so that
+# `yield_per` and server-side cursors keep their memory profile.
 original_query_iter = query.Query.__iter__
 def query_iter(self):
-    ret, clone = itertools.tee(original_query_iter(self))
+    ret = original_query_iter(self)
+    if not signals.is_active():
+        return ret
     signal = (
         signals.ignore_load
         if is_single(self._offset, self._limit)
         else signals.load
     )
-    signal.send(
-        signals.get_worker(),
-        args=(self, ),
-        ret=list(clone),
-        parser=parse_load,
+    return iter_loaded(ret, signal, self, self._yield_per or CHUNK_SIZE)
+
+
+def is_single_statement(statement):
+    try:
+        return is_single(statement._offset, statement._limit)
+    except (AttributeError, exc.CompileError):
+        # Textual statements, or limits given as SQL expressions
+        return False
+
+
+def iter_chunks(chunks, signal, statement):
+    for rows in chunks:
+        signals.send(
+            signal,
+            args=(statement, ),
+            ret=rows,
+            parser=parse_load,
+        )
+        yield rows
+
+
+def track_chunks(result, signal, statement):
+    """Record rows fetched by an ORM result as loaded, one chunk at a time.
+    Chunks follow the result's `yield_per` setting, or hold all rows.
+    """
+    chunks = result.chunks
+
+    def tracked(size):
+        return iter_chunks(chunks(size), signal, statement)
+    result.chunks = tracked
+    result.iterator = itertools.chain.from_iterable(tracked(result._yield_per))
+
+
+# Emit `load` or `ignore_load` for rows fetched by any ORM select, whether
+# issued through `Session.execute` or a legacy `Query`. Note: we wrap the
+# result built by `loading.instances` rather than re-invoking statements from
+# `do_orm_execute`, which passes arguments to `Session.get_bind` that
+# overridden implementations (e.g. in Flask-SQLAlchemy 2.x) may not accept.
+original_instances = loading.instances
+def instances(cursor, context):
+    result = original_instances(cursor, context)
+    if not signals.is_active():
+        return result
+    statement = context.query
+    signal = (
+        signals.ignore_load
+        if is_single_statement(statement)
+        else signals.load
     )
-    return ret
-query.Query.__iter__ = query_iter
+    track_chunks(result, signal, statement)
+    return result
 
 
 def parse_get(args, kwargs, context, ret):
-    return [to_key(ret)] if hasattr(ret, '__table__') else []
+    if hasattr(ret, '__table__'):
+        return [to_key(ret)]
+    # Unwrap entities from rows, as returned by `Result.one` or by queries
+    # for multiple entities
+    if hasattr(ret, '_fields'):
+        return [to_key(value) for value in ret if hasattr(value, '__table__')]
+    return []
 
 
-# Ignore records loaded during `one`
-for method in ['one_or_none', 'one']:
-    try:
-        original = getattr(query.Query, method)
-    except AttributeError:
-        continue
-    decorated = signals.signalify(signals.ignore_load, original, parse_get)
-    setattr(query.Query, method, decorated)
+def setup(patcher):
+    # Runs last on uninstalling, once native methods are restored
+    patcher.defer(uninstrument)
+
+    patcher.setattr(strategies.LazyLoader, '_load_for_state', load_for_state)
+    patcher.setattr(loading, '_populate_full', _populate_full)
+    patcher.setattr(strategies.SelectInLoader, '_load_for_path', _load_for_path)
+
+    # SQLAlchemy 1.4 runs legacy queries through `Session.execute`, so
+    # tracking ORM results covers both APIs there; older versions need
+    # `Query` patched
+    if ChunkedIteratorResult is None:
+        patcher.setattr(query.Query, '__iter__', query_iter)
+        methods = [
+            (query.Query, 'one_or_none'),
+            (query.Query, 'one'),
+        ]
+    else:
+        patcher.setattr(loading, 'instances', instances)
+        methods = [
+            (Result, 'one_or_none'),
+            (Result, 'one'),
+            (Result, 'scalar_one_or_none'),
+            (Result, 'scalar_one'),
+            (Result, 'first'),
+            (Result, 'scalar'),
+            (ScalarResult, 'one_or_none'),
+            (ScalarResult, 'one'),
+            (ScalarResult, 'first'),
+        ]
+
+    # Ignore records returned singly, as from `one` or `first`; on older
+    # versions, `Query.first` is covered by its limit
+    for cls, method in methods:
+        try:
+            original = getattr(cls, method)
+        except AttributeError:
+            continue
+        decorated = signals.signalify(signals.ignore_load, original, parse_get)
+        patcher.setattr(cls, method, decorated)
+
+    event.listen(Mapper, 'mapper_configured', mapper_configured)
+    event.listen(Mapper, 'after_configured', after_configured)
+    patcher.defer(event.remove, Mapper, 'mapper_configured', mapper_configured)
+    patcher.defer(event.remove, Mapper, 'after_configured', after_configured)
+
+    # Handle mappers configured before installing
+    for mapper in get_mappers():
+        if mapper.configured:
+            mappers.add(mapper)
+    after_configured()
+
+
+patcher = patching.Patcher(setup)
+
+
+def install():
+    """Patch SQLAlchemy to emit nplusone signals. Called when the first profiling
+    session starts after import.
+    """
+    patcher.install()
+
+
+def uninstall():
+    """Restore the methods and attributes replaced by `install`."""
+    patcher.uninstall()
+
+
+patching.register(patcher)
@@ -1,14 +1,28 @@
 # -*- coding: utf-8 -*-
 
 from nplusone.core import profiler
+from nplusone.core import sampling
+from nplusone.core import listeners
 
 
 class NPlusOneMiddleware(object):
 
-    def __init__(self, app, whitelist=None):
+    def __init__(self, app, whitelist=None, sample_rate=1.0, sample_rates=None,
+                 **options):
         self.app = app
-        self.whitelist = whitelist
+        self.whitelist = listeners.Whitelist(whitelist)
+        self.options = options
+        self.sampler = sampling.Sampler(rate=sample_rate, rates=sample_rates)
 
     def __call__(self, environ, start_response):
-        with profiler.Profiler(whitelist=self.whitelist):
+        endpoint = environ.get('PATH_INFO')
+        rate = self.sampler.sample(endpoint)
+        if not rate:
+            return self.app(environ, start_response)
+        with profiler.Profiler(
+            whitelist=self.whitelist,
+            endpoint=endpoint,
+            sample_rate=rate,
+            **self.options
+        ):
             return self.app(environ, start_response)
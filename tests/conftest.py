@@ -15,7 +15,16 @@ PATTERNS = [
 
 
 @pytest.fixture
-def calls():
+def profiling():
+    session = signals.start_session()
+    try:
+        yield session
+    finally:
+        signals.end_session(session)
+
+
+@pytest.fixture
+def calls(profiling):
     calls = []
     def subscriber(sender, args=None, kwargs=None, context=None, ret=None, parser=None):
         calls.append(
@@ -24,12 +33,12 @@ def calls():
                 stack.get_caller(patterns=PATTERNS)
             )
         )
-    signals.lazy_load.connect(subscriber, sender=signals.get_worker())
+    signals.connect(signals.lazy_load, subscriber)
     yield calls
 
 
 @pytest.fixture
-def lazy_listener():
+def lazy_listener(profiling):
     mock_parent = mock.Mock()
     listener = listeners.LazyListener(mock_parent)
     listener.setup()
@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+
+import gc
+import os
+import json
+import time
+import weakref
+import threading
+
+import mock
+import pytest
+
+from nplusone.core import stats
+from nplusone.core import notifiers
+from nplusone.core import profiler
+from nplusone.core import listeners
+from nplusone.core import exceptions
+
+
+class User(object):
+    pass
+
+
+class Address(object):
+    pass
+
+
+class Hobby(object):
+    pass
+
+
+def test_eager_tracker_touch():
+    def unused_keys():
+        raise AssertionError('keys computed for untracked association')
+        yield  # pragma: no cover
+    tracker = listeners.EagerTracker()
+    tracker.track(User, 'hobbies', [(User, 1)], 'query')
+    tracker.touch(User, 'addresses', unused_keys())
+    assert tracker.unused == [(User, 'hobbies')]
+    tracker.touch(User, 'hobbies', iter([(User, 1)]))
+    assert tracker.unused == []
+    tracker.track(User, 'hobbies', [(User, 2)], 'query')
+    assert tracker.unused == []
+
+
+@pytest.mark.parametrize('item', [
+    {'label': 'n_plus_one'},
+    {'field': 'hobbies'},
+    {'model': User},
+    {'model': 'User'},
+    {'model': 'User', 'label': 'n_plus_one', 'field': 'addresses'},
+    {'model': 'Us*'},
+    {'model': 'Us?r', 'field': 'addresses'},
+    {'model': '[AH]*', 'label': 'unused_eager_load'},
+    {'model': 'User.*'},
+    {},
+])
+def test_whitelist(item):
+    rule = listeners.Rule(**item)
+    whitelist = listeners.Whitelist([item, {'model': 'Decoy*'}], max_size=2)
+    for label in ['n_plus_one', 'unused_eager_load']:
+        for model in [User, Address, Hobby]:
+            for field in ['addresses', 'hobbies']:
+                expected = bool(rule.compare(label, model, field))
+                assert whitelist.match(label, model, field) is expected
+                assert whitelist.match(label, model, field) is expected
+    assert len(whitelist.cache) == 2
+
+
+def test_identity_set_capacity():
+    keys = listeners.IdentitySet(max_size=2000)
+    keys.update((User, pk) for pk in range(2001))
+    assert keys.overflowed == 1
+    assert keys.overflow.capacity == 2000
+    assert (User, 2000) in keys
+    assert listeners.IdentitySet(max_size=0).capacity == 1000
+    assert listeners.IdentitySet(max_size=0, capacity=50000).capacity == 50000
+
+
+def test_identity_set_options():
+    options = listeners.get_options({
+        'NPLUSONE_MAX_TRACKED': 10,
+        'NPLUSONE_BLOOM_CAPACITY': 5000,
+    })
+    profile = profiler.Profiler(**options)
+    with profile:
+        loaded = profile.session.listeners['lazy_load'].loaded
+        assert loaded.max_size == 10
+        assert loaded.capacity == 5000
+
+
+def test_stats(monkeypatch):
+    stats.reset()
+    snapshots = []
+    stats.add_hook(snapshots.append)
+    try:
+        whitelist = [{'model': 'User', 'field': 'hobbies'}]
+        for field in ['addresses', 'hobbies', 'addresses']:
+            profile = profiler.Profiler(whitelist, endpoint='users', sample_rate=0.5)
+            try:
+                with profile:
+                    listener = profile.session.listeners['lazy_load']
+                    listener.notify(listeners.LazyLoadMessage(User, field))
+            except exceptions.NPlusOneError:
+                pass
+        thread = threading.Thread(
+            target=stats.record,
+            args=('users', 'n_plus_one', User, 'addresses'),
+        )
+        thread.start()
+        thread.join()
+        assert not snapshots
+        monkeypatch.setattr(stats.registry, 'flushed', 0)
+        stats.tick()
+    finally:
+        stats.remove_hook(snapshots.append)
+    assert len(snapshots) == 1
+    stat, = snapshots[0]
+    assert stat[:4] == ('users', 'n_plus_one', User, 'addresses')
+    assert stat.count == 3
+    assert stat.estimated == 5
+    assert stat.first_seen <= stat.last_seen
+    stats.reset()
+    assert stats.snapshot() == []
+
+
+def test_stats_threads():
+    stats.reset()
+    for _ in range(20):
+        thread = threading.Thread(
+            target=stats.record,
+            args=('users', 'n_plus_one', User, 'addresses'),
+        )
+        thread.start()
+        thread.join()
+    stats.record('users', 'n_plus_one', User, 'addresses')
+    assert len(stats.registry.shards) <= 2
+    stat, = stats.snapshot()
+    assert stat.count == 21
+    stats.reset()
+
+
+def test_async_notifier():
+    started = threading.Event()
+    release = threading.Event()
+    received = []
+
+    class Blocking(object):
+        def notify(self, message):
+            started.set()
+            release.wait()
+            received.append(message)
+
+    notifier = notifiers.AsyncNotifier({'NPLUSONE_QUEUE_SIZE': 2}, [Blocking()])
+    messages = [listeners.LazyLoadMessage(User, str(index)) for index in range(4)]
+    notifier.notify(messages[0])
+    assert started.wait(5)
+    for message in messages[1:]:
+        notifier.notify(message)
+    assert notifier.dropped == 1
+    release.set()
+    notifier.flush()
+    assert received == [messages[0], messages[2], messages[3]]
+
+
+def test_async_notifier_fork():
+    notifier = notifiers.AsyncNotifier({}, [])
+    notifier.pid = -1
+    notifier.queue.append(listeners.LazyLoadMessage(User, 'addresses'))
+    notifier.start()
+    assert not notifier.queue
+    assert notifier.pid == os.getpid()
+
+
+def test_async_notifier_exit(tmpdir):
+    path = tmpdir.join('nplusone.jsonl')
+    config = {
+        'NPLUSONE_ASYNC': True,
+        'NPLUSONE_JSON_FILE': str(path),
+        'NPLUSONE_JSON_FLUSH_INTERVAL': 60,
+        'NPLUSONE_LOG': False,
+    }
+    notifier, = notifiers.init(config)
+    notifier.notify(listeners.LazyLoadMessage(User, 'addresses'))
+    notifiers.flush_all()
+    assert len(path.readlines()) == 1
+
+
+def test_async_notifier_init():
+    config = {'NPLUSONE_ASYNC': True, 'NPLUSONE_RAISE': True}
+    async_notifier, error_notifier = notifiers.init(config)
+    assert isinstance(async_notifier, notifiers.AsyncNotifier)
+    assert isinstance(async_notifier.notifiers[0], notifiers.LogNotifier)
+    assert isinstance(error_notifier, notifiers.ErrorNotifier)
+
+
+def test_json_notifier(tmpdir):
+    path = tmpdir.join('nplusone.jsonl')
+    notifier = notifiers.JSONNotifier({
+        'NPLUSONE_JSON_FILE': str(path),
+        'NPLUSONE_JSON_BATCH_SIZE': 2,
+        'NPLUSONE_JSON_FLUSH_INTERVAL': 60,
+    })
+    message = listeners.LazyLoadMessage(User, 'addresses')
+    message.count = 3
+    message.endpoint = 'users'
+    notifier.notify(message)
+    assert not path.exists()
+    notifier.notify(listeners.EagerLoadMessage(Hobby, 'users'))
+    records = [json.loads(line) for line in path.readlines()]
+    assert len(records) == 2
+    assert records[0]['label'] == 'n_plus_one'
+    assert records[0]['model'] == 'User'
+    assert records[0]['field'] == 'addresses'
+    assert records[0]['count'] == 3
+    assert records[0]['endpoint'] == 'users'
+    assert records[0]['pid'] == os.getpid()
+    assert records[1]['label'] == 'unused_eager_load'
+    assert records[1]['endpoint'] is None
+    notifier.notify(message)
+    notifier.flush()
+    assert len(path.readlines()) == 3
+
+
+def test_json_notifier_interval(tmpdir):
+    path = tmpdir.join('nplusone.jsonl')
+    notifier = notifiers.JSONNotifier({
+        'NPLUSONE_JSON_FILE': str(path),
+        'NPLUSONE_JSON_FLUSH_INTERVAL': 0.01,
+    })
+    notifier.notify(listeners.LazyLoadMessage(User, 'addresses'))
+    for _ in range(500):
+        if path.exists():
+            break
+        time.sleep(0.01)
+    assert len(path.readlines()) == 1
+
+
+def test_json_notifier_fork(tmpdir):
+    path = tmpdir.join('nplusone.jsonl')
+    notifier = notifiers.JSONNotifier({
+        'NPLUSONE_JSON_FILE': str(path),
+        'NPLUSONE_JSON_FLUSH_INTERVAL': 60,
+    })
+    notifier.notify(listeners.LazyLoadMessage(User, 'addresses'))
+    notifier.timer.cancel()
+    lock = notifier.lock
+    notifier.pid = -1
+    notifier.notify(listeners.EagerLoadMessage(Hobby, 'users'))
+    assert notifier.lock is not lock
+    assert notifier.pid == os.getpid()
+    notifier.timer.cancel()
+    notifier.flush()
+    record, = [json.loads(line) for line in path.readlines()]
+    assert record['label'] == 'unused_eager_load'
+
+
+def test_json_notifier_error(tmpdir):
+    notifier = notifiers.JSONNotifier({
+        'NPLUSONE_JSON_FILE': str(tmpdir.join('missing', 'nplusone.jsonl')),
+        'NPLUSONE_JSON_BATCH_SIZE': 1,
+    })
+    with mock.patch.object(notifiers.logger, 'exception') as exception:
+        notifier.notify(listeners.LazyLoadMessage(User, 'addresses'))
+    assert exception.called
+
+
+def test_json_notifier_release(tmpdir):
+    notifier = notifiers.JSONNotifier({
+        'NPLUSONE_JSON_FILE': str(tmpdir.join('nplusone.jsonl')),
+    })
+    assert notifier in notifiers.exiting
+    ref = weakref.ref(notifier)
+    del notifier
+    gc.collect()
+    assert ref() is None
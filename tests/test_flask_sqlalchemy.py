@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 
+import json
 import mock
 import flask
 import pytest
@@ -7,18 +8,13 @@ import webtest
 import sqlalchemy as sa
 from flask_sqlalchemy import SQLAlchemy
 
+from nplusone.core import sampling
 from nplusone.core import exceptions
 from nplusone.ext.flask_sqlalchemy import NPlusOne
-from nplusone.ext.flask_sqlalchemy import setup_state
 
 from tests import utils
 
 
-@pytest.fixture(scope='module', autouse=True)
-def setup():
-    setup_state()
-
-
 @pytest.fixture
 def db():
     return SQLAlchemy()
@@ -69,6 +65,11 @@ def routes(app, models, wrapper):
         users = models.User.query.all()
         return str(users[0].addresses)
 
+    @app.route('/many_to_one_all/')
+    def many_to_one_all():
+        users = models.User.query.all()
+        return str([user.addresses for user in users])
+
     @app.route('/many_to_one_one/')
     def many_to_one_one():
         user = models.User.query.filter_by(id=1).one()
@@ -124,6 +125,16 @@ def routes(app, models, wrapper):
         users = models.User.query.options(sa.orm.subqueryload('hobbies')).all()
         return str(users[0])
 
+    @app.route('/eager_selectin/')
+    def eager_selectin():
+        users = models.User.query.options(sa.orm.selectinload(models.User.hobbies)).all()
+        return str(users[0].hobbies if users else None)
+
+    @app.route('/eager_selectin_unused/')
+    def eager_selectin_unused():
+        users = models.User.query.options(sa.orm.selectinload(models.User.hobbies)).all()
+        return str(users[0])
+
     @app.route('/eager_nested/')
     def eager_nested():
         hobbies = models.Hobby.query.options(
@@ -212,6 +223,21 @@ class TestNPlusOne:
         args = logger.log.call_args[0]
         assert 'User.hobbies' in args[1]
 
+    def test_eager_selectin(self, objects, client, logger):
+        client.get('/eager_selectin/')
+        assert not logger.log.called
+
+    def test_eager_selectin_empty(self, models, objects, client, logger):
+        models.User.query.delete()
+        client.get('/eager_selectin/')
+        assert not logger.log.called
+
+    def test_eager_selectin_unused(self, objects, client, logger):
+        client.get('/eager_selectin_unused/')
+        assert len(logger.log.call_args_list) == 1
+        args = logger.log.call_args[0]
+        assert 'User.hobbies' in args[1]
+
     def test_eager_nested_unused(self, app, wrapper, objects, client, logger):
         client.get('/eager_nested/')
         assert not logger.log.called
@@ -242,3 +268,119 @@ class TestNPlusOne:
         app.config['NPLUSONE_WHITELIST'] = [{'model': 'Hobby'}]
         client.get('/many_to_many/')
         assert logger.log.called
+
+    def test_load_config(self, app, wrapper, objects, client, logger):
+        client.get('/many_to_many/')
+        assert logger.log.call_count == 1
+        app.config['NPLUSONE_WHITELIST'] = [{'model': 'User'}]
+        client.get('/many_to_many/')
+        assert logger.log.call_count == 2
+        wrapper.load_config(app)
+        client.get('/many_to_many/')
+        assert logger.log.call_count == 2
+
+    def test_aggregate(self, app, db, models, wrapper, objects, client, logger):
+        db.session.add_all([models.User(), models.User()])
+        db.session.commit()
+        client.get('/many_to_one_all/')
+        assert len(logger.log.call_args_list) == 3
+        logger.reset_mock()
+        app.config['NPLUSONE_AGGREGATE'] = True
+        wrapper.load_config(app)
+        client.get('/many_to_one_all/')
+        assert len(logger.log.call_args_list) == 1
+        args = logger.log.call_args[0]
+        assert args[1].endswith('`User.addresses` (3 times)')
+
+    def test_async(self, app, wrapper, objects, client, logger):
+        app.config['NPLUSONE_ASYNC'] = True
+        client.get('/many_to_many/')
+        app.extensions['nplusone'].notifiers[0].flush()
+        assert logger.log.call_count == 1
+
+    def test_json(self, app, wrapper, objects, client, logger, tmpdir):
+        path = tmpdir.join('nplusone.jsonl')
+        app.config['NPLUSONE_JSON_FILE'] = str(path)
+        app.config['NPLUSONE_JSON_BATCH_SIZE'] = 1
+        client.get('/many_to_many/')
+        record, = [json.loads(line) for line in path.readlines()]
+        assert record['model'] == 'User'
+        assert record['field'] == 'hobbies'
+        assert record['endpoint'] == 'many_to_many'
+
+    def test_many_to_many_unsampled(self, app, wrapper, objects, client, logger):
+        app.config['NPLUSONE_SAMPLE_RATE'] = 0
+        client.get('/many_to_many/')
+        assert not logger.log.called
+
+    def test_many_to_many_sample_rates(self, app, wrapper, objects, client, logger):
+        app.config['NPLUSONE_SAMPLE_RATE'] = 0
+        app.config['NPLUSONE_SAMPLE_RATES'] = {'many_to_many': 1}
+        client.get('/many_to_one/')
+        assert not logger.log.called
+        client.get('/many_to_many/')
+        assert logger.log.called
+
+    def test_many_to_many_sample_tag(self, app, wrapper, objects, client, monkeypatch):
+        monkeypatch.setattr(sampling.random, 'random', lambda: 0.25)
+        app.config['NPLUSONE_SAMPLE_RATE'] = 0.5
+        with mock.patch.object(wrapper, 'notify') as notify:
+            client.get('/many_to_many/')
+        message = notify.call_args[0][0]
+        assert message.sample_rate == 0.5
+
+    def test_adaptive_sampling(self, app, wrapper, objects, client, monkeypatch):
+        monkeypatch.setattr(sampling.random, 'random', lambda: 0.3)
+        app.config['NPLUSONE_SAMPLE_ADAPTIVE'] = True
+        app.config['NPLUSONE_SAMPLE_DECAY'] = 0.5
+        app.config['NPLUSONE_SAMPLE_FLOOR'] = 0.1
+        client.get('/many_to_one_one/')
+        client.get('/many_to_one_one/')
+        client.get('/many_to_many/')
+        state = app.extensions['nplusone']
+        assert state.sampler.get_rate('many_to_one_one') == 0.25
+        assert state.sampler.get_rate('many_to_many') == 1
+        assert state.endpoints['many_to_many'].last_detected is not None
+
+    def test_adaptive_sampling_whitelist(self, app, wrapper, objects, client,
+                                         monkeypatch):
+        monkeypatch.setattr(sampling.random, 'random', lambda: 0.3)
+        app.config['NPLUSONE_SAMPLE_ADAPTIVE'] = True
+        app.config['NPLUSONE_SAMPLE_DECAY'] = 0.5
+        app.config['NPLUSONE_WHITELIST'] = [{'model': 'User'}]
+        client.get('/many_to_many/')
+        client.get('/many_to_many/')
+        state = app.extensions['nplusone']
+        assert state.sampler.get_rate('many_to_many') == 0.25
+
+    def test_deferred(self, app, wrapper, objects, client, logger):
+        app.config['NPLUSONE_DEFERRED'] = True
+        client.get('/many_to_one_ignore/')
+        assert not logger.log.called
+        client.get('/many_to_many/')
+        client.get('/eager_join_unused/')
+        assert len(logger.log.call_args_list) == 2
+        calls = [call[0] for call in logger.log.call_args_list]
+        assert all('User.hobbies' in call[1] for call in calls)
+
+
+def test_init_app_multiple(app, models, objects, logger):
+    other = flask.Flask('other')
+    extension = NPlusOne()
+    extension.init_app(other)
+    extension.init_app(app)
+    app.config['NPLUSONE_RAISE'] = True
+
+    @other.route('/')
+    def index():
+        return ''
+
+    @app.route('/many_to_many/')
+    def many_to_many():
+        users = models.User.query.all()
+        return str(users[0].hobbies)
+
+    other.test_client().get('/')
+    with pytest.raises(exceptions.NPlusOneError):
+        app.test_client().get('/many_to_many/')
+    assert other.extensions['nplusone'] is not app.extensions['nplusone']
@@ -1,13 +1,10 @@
 # -*- coding: utf-8 -*-
 
-import threading
-
 import flask
 import pytest
 import webtest
 from flask_sqlalchemy import SQLAlchemy
 
-from nplusone.core import signals
 from nplusone.core import exceptions
 from nplusone.ext.wsgi import NPlusOneMiddleware
 import nplusone.ext.sqlalchemy  # noqa
@@ -15,15 +12,6 @@ import nplusone.ext.sqlalchemy  # noqa
 from tests import utils
 
 
-def get_worker():
-    return str(threading.current_thread().ident)
-
-
-@pytest.fixture(scope='module', autouse=True)
-def setup():
-    signals.get_worker = get_worker
-
-
 @pytest.fixture
 def db():
     return SQLAlchemy()
@@ -87,3 +75,7 @@ class TestNPlusOneMiddleware:
 
     def test_many_to_one_one(self, objects, client):
         client.get('/many_to_one_one/')
+
+    def test_many_to_one_unsampled(self, objects, app, routes):
+        client = webtest.TestApp(NPlusOneMiddleware(app, sample_rate=0))
+        client.get('/many_to_one/')
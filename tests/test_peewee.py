@@ -4,7 +4,7 @@ import pytest
 import peewee as pw
 
 from nplusone.core import signals
-import nplusone.ext.peewee  # noqa
+import nplusone.ext.peewee
 
 from tests.utils import Bunch
 
@@ -76,7 +76,7 @@ class TestManyToOne:
         list(users[0].addresses)
         assert len(calls) == 1
         call = calls[0]
-        assert call.objects == (models.User, 'User:1', 'addresses')
+        assert call.objects == (models.User, (models.User, 1), 'addresses')
         assert 'users[0].addresses' in ''.join(call.frame[4])
         assert lazy_listener.parent.notify
 
@@ -85,7 +85,7 @@ class TestManyToOne:
         list(user.addresses)
         assert len(calls) == 1
         call = calls[0]
-        assert call.objects == (models.User, 'User:1', 'addresses')
+        assert call.objects == (models.User, (models.User, 1), 'addresses')
         assert 'user.addresses' in ''.join(call.frame[4])
         assert not lazy_listener.parent.notify.called
 
@@ -108,7 +108,7 @@ class TestManyToOne:
         address.user
         assert len(calls) == 1
         call = calls[0]
-        assert call.objects == (models.Address, 'Address:1', 'user')
+        assert call.objects == (models.Address, (models.Address, 1), 'user')
         assert 'address.user' in ''.join(call.frame[4])
 
     def test_many_to_one_reverse_join(self, models, session, objects, calls):
@@ -137,7 +137,7 @@ class TestManyToMany:
         list(users[0].hobbies)
         assert len(calls) == 1
         call = calls[0]
-        assert call.objects == (models.User, 'User:1', 'hobbies')
+        assert call.objects == (models.User, (models.User, 1), 'hobbies')
         assert 'users[0].hobbies' in ''.join(call.frame[4])
 
     def test_many_to_many_reverse(self, models, session, objects, calls):
@@ -145,5 +145,18 @@ class TestManyToMany:
         list(hobby.users)
         assert len(calls) == 1
         call = calls[0]
-        assert call.objects == (models.Hobby, 'Hobby:1', 'users')
+        assert call.objects == (models.Hobby, (models.Hobby, 1), 'users')
         assert 'hobby.users' in ''.join(call.frame[4])
+
+
+def test_uninstall(models, session, objects, calls):
+    nplusone.ext.peewee.uninstall()
+    try:
+        users = models.User.select()
+        list(users[0].addresses)
+        assert len(calls) == 0
+    finally:
+        nplusone.ext.peewee.install()
+    users = models.User.select()
+    list(users[0].addresses)
+    assert len(calls) == 1
@@ -1,13 +1,20 @@
 # -*- coding: utf-8 -*-
 
+import threading
+
 import pytest
 import sqlalchemy as sa
 from sqlalchemy.ext.declarative import declarative_base
 
+from nplusone.core import stats
 from nplusone.core import signals
+from nplusone.core import patching
 from nplusone.core import profiler
+from nplusone.core import listeners
 from nplusone.core import exceptions
-import nplusone.ext.sqlalchemy  # noqa
+import nplusone.ext.sqlalchemy
+from nplusone.ext.sqlalchemy import RelationshipAttribute
+from nplusone.ext.sqlalchemy import ChunkedIteratorResult
 
 from tests import utils
 
@@ -18,6 +25,12 @@ Base = declarative_base()
 models = utils.make_models(Base)
 
 
+class Membership(Base):
+    __tablename__ = 'membership'
+    user_id = sa.Column('member_id', sa.Integer, primary_key=True)
+    group = sa.Column(sa.String, primary_key=True)
+
+
 @pytest.fixture()
 def session():
     engine = sa.create_engine('sqlite:///:memory:')
@@ -43,7 +56,7 @@ class TestManyToOne:
         users[0].addresses
         assert len(calls) == 1
         call = calls[0]
-        assert call.objects == (models.User, 'User:1', 'addresses')
+        assert call.objects == (models.User, (models.User, 1), 'addresses')
         assert 'users[0].addresses' in ''.join(call.frame[4])
 
     def test_many_to_one_ignore(self, session, objects, calls):
@@ -52,17 +65,32 @@ class TestManyToOne:
             users[0].addresses
         assert len(calls) == 0
 
+    def test_many_to_one_ignore_nested(self, session, objects, calls):
+        users = session.query(models.User).all()
+        with signals.ignore(signals.lazy_load):
+            with signals.ignore(signals.lazy_load):
+                users[0].addresses
+            users[0].hobbies
+        assert len(calls) == 0
+        session.expire(users[0])
+        users[0].addresses
+        assert len(calls) == 1
+
     def test_many_to_one_subquery(self, session, objects, calls):
         users = session.query(
             models.User
         ).options(
-            sa.orm.subqueryload('addresses')
+            sa.orm.subqueryload(models.User.addresses)
         ).all()
         users[0].addresses
         assert len(calls) == 0
 
     def test_many_to_one_joined(self, session, objects, calls):
-        users = session.query(models.User).options(sa.orm.joinedload('addresses')).all()
+        users = session.query(
+            models.User
+        ).options(
+            sa.orm.joinedload(models.User.addresses)
+        ).all()
         users[0].addresses
         assert len(calls) == 0
 
@@ -71,20 +99,24 @@ class TestManyToOne:
         addresses[0].user
         assert len(calls) == 1
         call = calls[0]
-        assert call.objects == (models.Address, 'Address:1', 'user')
+        assert call.objects == (models.Address, (models.Address, 1), 'user')
         assert 'addresses[0].user' in ''.join(call.frame[4])
 
     def test_many_to_one_reverse_subquery(self, session, objects, calls):
         addresses = session.query(
             models.Address
         ).options(
-            sa.orm.subqueryload('user')
+            sa.orm.subqueryload(models.Address.user)
         ).all()
         addresses[0].user
         assert len(calls) == 0
 
     def test_many_to_one_reverse_joined(self, session, objects, calls):
-        address = session.query(models.Address).options(sa.orm.joinedload('user')).first()
+        address = session.query(
+            models.Address
+        ).options(
+            sa.orm.joinedload(models.Address.user)
+        ).first()
         address.user
         assert len(calls) == 0
 
@@ -96,16 +128,24 @@ class TestManyToMany:
         users[0].hobbies
         assert len(calls) == 1
         call = calls[0]
-        assert call.objects == (models.User, 'User:1', 'hobbies')
+        assert call.objects == (models.User, (models.User, 1), 'hobbies')
         assert 'users[0].hobbies' in ''.join(call.frame[4])
 
     def test_many_to_many_subquery(self, session, objects, calls):
-        user = session.query(models.User).options(sa.orm.subqueryload('hobbies')).first()
+        user = session.query(
+            models.User
+        ).options(
+            sa.orm.subqueryload(models.User.hobbies)
+        ).first()
         user.hobbies
         assert len(calls) == 0
 
     def test_many_to_many_joined(self, session, objects, calls):
-        user = session.query(models.User).options(sa.orm.joinedload('hobbies')).first()
+        user = session.query(
+            models.User
+        ).options(
+            sa.orm.joinedload(models.User.hobbies)
+        ).first()
         user.hobbies
         assert len(calls) == 0
 
@@ -114,20 +154,113 @@ class TestManyToMany:
         hobbies[0].users
         assert len(calls) == 1
         call = calls[0]
-        assert call.objects == (models.Hobby, 'Hobby:1', 'users')
+        assert call.objects == (models.Hobby, (models.Hobby, 1), 'users')
         assert 'hobbies[0].users' in ''.join(call.frame[4])
 
     def test_many_to_many_reverse_subquery(self, session, objects, calls):
-        hobby = session.query(models.Hobby).options(sa.orm.subqueryload('users')).first()
+        hobby = session.query(
+            models.Hobby
+        ).options(
+            sa.orm.subqueryload(models.Hobby.users)
+        ).first()
         hobby.users
         assert len(calls) == 0
 
     def test_many_to_many_reverse_joined(self, session, objects, calls):
-        hobby = session.query(models.Hobby).options(sa.orm.joinedload('users')).first()
+        hobby = session.query(
+            models.Hobby
+        ).options(
+            sa.orm.joinedload(models.Hobby.users)
+        ).first()
         hobby.users
         assert len(calls) == 0
 
 
+@pytest.mark.skipif(
+    ChunkedIteratorResult is None,
+    reason='requires SQLAlchemy 1.4',
+)
+class TestExecute:
+
+    def test_many_to_one(self, session, objects, calls):
+        users = session.execute(sa.select(models.User)).scalars().all()
+        users[0].addresses
+        assert len(calls) == 1
+        call = calls[0]
+        assert call.objects == (models.User, (models.User, 1), 'addresses')
+        assert 'users[0].addresses' in ''.join(call.frame[4])
+
+    def test_many_to_one_profile(self, session, objects):
+        with profiler.Profiler():
+            users = session.execute(sa.select(models.User)).scalars().all()
+            with pytest.raises(exceptions.NPlusOneError):
+                users[0].addresses
+
+    def test_many_to_one_one(self, session, objects):
+        with profiler.Profiler():
+            user = session.execute(sa.select(models.User)).scalar_one()
+            user.addresses
+
+    def test_many_to_one_one_row(self, session, objects):
+        with profiler.Profiler():
+            row = session.execute(sa.select(models.User)).one()
+            row[0].addresses
+
+    def test_many_to_one_first(self, session, objects):
+        session.add(models.User())
+        session.commit()
+        with profiler.Profiler():
+            user = session.execute(sa.select(models.User)).scalars().first()
+            user.addresses
+            row = session.execute(sa.select(models.User, models.Address)).first()
+            row[0].addresses
+
+    def test_many_to_one_limit(self, session, objects):
+        with profiler.Profiler():
+            statement = sa.select(models.User).limit(1)
+            users = session.execute(statement).scalars().all()
+            users[0].addresses
+
+    def test_many_to_one_get(self, session, objects):
+        with profiler.Profiler():
+            user = session.get(models.User, 1)
+            user.addresses
+
+    def test_many_to_one_streaming(self, session, objects, lazy_listener):
+        session.add_all([models.User(), models.User()])
+        session.commit()
+        result = session.execute(
+            sa.select(models.User).execution_options(yield_per=1)
+        )
+        rows = iter(result.scalars())
+        next(rows)
+        assert len(lazy_listener.loaded) == 1
+        list(rows)
+        assert len(lazy_listener.loaded) == 3
+
+
+def test_many_to_one_one_multiple(session, objects):
+    with profiler.Profiler():
+        user, address = session.query(models.User, models.Address).one()
+        user.addresses
+
+
+def test_load_streaming(session, objects, lazy_listener):
+    session.add_all([models.User(), models.User()])
+    session.commit()
+    rows = iter(session.query(models.User).yield_per(1))
+    next(rows)
+    assert len(lazy_listener.loaded) == 1
+    list(rows)
+    assert len(lazy_listener.loaded) == 3
+
+
+def test_lazy_load_streaming(session, objects, calls):
+    for user in session.query(models.User).yield_per(1):
+        user.addresses
+    assert len(calls) == 1
+
+
 def test_non_orm_query(session, objects, lazy_listener):
     session.query(models.Address.id).all()
 
@@ -141,6 +274,226 @@ class TestProfile:
                 users[0].addresses
 
     def test_profile_whitelist(self, session, objects):
-        with profiler.Profiler(whitelist=[{'model': 'User'}]):
+        profile = profiler.Profiler(whitelist=[{'model': 'User'}])
+        with profile:
             users = session.query(models.User).all()
             users[0].addresses
+        assert profile.session.detections == 0
+
+    def test_profile_deferred(self, session, objects):
+        profile = profiler.Profiler(deferred=True)
+        with pytest.raises(exceptions.NPlusOneError):
+            with profile:
+                users = session.query(models.User).all()
+                users[0].addresses
+                assert profile.session.buffered
+        assert profile.session.buffered == 0
+
+    def test_profile_deferred_spill(self, session, objects):
+        profile = profiler.Profiler(deferred=True, buffer_size=1)
+        with pytest.raises(exceptions.NPlusOneError):
+            with profile:
+                users = session.query(models.User).all()
+                users[0].addresses
+        assert profile.session.spilled
+        assert profile.session.detections == 1
+
+    def test_profile_deferred_spill_eager(self, session):
+        session.add_all([
+            models.User(addresses=[models.Address()])
+            for _ in range(250)
+        ])
+        session.commit()
+        session.close()
+        profile = profiler.Profiler(deferred=True, buffer_size=150)
+        with profile:
+            users = session.query(models.User).options(
+                sa.orm.joinedload(models.User.addresses)
+            ).all()
+            for user in users:
+                user.addresses
+            # Buffered events must not depend on instances staying alive
+            del users, user
+        assert profile.session.spilled
+        assert profile.session.detections == 0
+
+    def test_profile_deferred_expired(self, session):
+        session.add_all([
+            models.User(addresses=[models.Address()])
+            for _ in range(2)
+        ])
+        session.commit()
+        session.close()
+        profile = profiler.Profiler(deferred=True)
+        with profile:
+            address = session.query(models.Address).filter_by(id=1).one()
+            user = address.user
+            session.query(models.User).filter(models.User.id > 1).all()
+            user.addresses
+            # Expires loaded instances before buffered events are processed
+            session.commit()
+        assert profile.session.detections == 0
+
+    def test_profile_max_tracked(self, session, objects):
+        fallbacks = listeners.IdentitySet.fallbacks
+        profile = profiler.Profiler(max_tracked=0)
+        with pytest.raises(exceptions.NPlusOneError):
+            with profile:
+                users = session.query(models.User).all()
+                users[0].addresses
+        assert listeners.IdentitySet.fallbacks == fallbacks + 1
+
+    def test_profile_aggregate(self, session, objects):
+        session.add_all([models.User(), models.User()])
+        session.commit()
+        stats.reset()
+        profile = profiler.Profiler(aggregate=True)
+        with pytest.raises(exceptions.NPlusOneError) as excinfo:
+            with profile:
+                users = session.query(models.User).all()
+                for user in users:
+                    user.addresses
+                    user.hobbies
+        assert str(excinfo.value).endswith('`User.addresses` (3 times)')
+        # Reporting stops at the first error
+        assert profile.session.detections == 3
+        stat, = stats.snapshot()
+        assert stat.field == 'addresses'
+        assert stat.count == 3
+        stats.reset()
+
+    def test_profile_receivers(self, session, objects):
+        signals_ = [signals.load, signals.lazy_load, signals.eager_load, signals.touch]
+        receivers = [dict(signal.receivers) for signal in signals_]
+        with profiler.Profiler():
+            users = session.query(
+                models.User
+            ).options(
+                sa.orm.joinedload(models.User.hobbies)
+            ).all()
+            users[0].hobbies
+            assert [dict(signal.receivers) for signal in signals_] == receivers
+
+    def test_profile_selectin(self, session, objects):
+        with profiler.Profiler():
+            users = session.query(
+                models.User
+            ).options(
+                sa.orm.selectinload(models.User.hobbies)
+            ).all()
+            users[0].hobbies
+
+    def test_profile_selectin_unused(self, session, objects):
+        query = session.query(
+            models.User
+        ).options(
+            sa.orm.selectinload(models.User.hobbies)
+        )
+        with pytest.raises(exceptions.NPlusOneError):
+            with profiler.Profiler():
+                users = query.all()
+                users[0].hobbies
+                # Touches on one query don't cover another
+                session.expunge_all()
+                query.all()
+
+    def test_profile_session_scope(self):
+        sessions = []
+        with profiler.Profiler():
+            thread = threading.Thread(
+                target=lambda: sessions.append(signals.get_session()),
+            )
+            thread.start()
+            thread.join()
+            assert signals.get_session() is not None
+        assert sessions == [None]
+        assert signals.get_session() is None
+
+
+def test_inactive(session, objects):
+    sent = []
+    def subscriber(sender, **kwargs):
+        sent.append(kwargs)
+    for signal in (signals.load, signals.lazy_load, signals.touch):
+        signal.connect(subscriber)
+    try:
+        users = session.query(models.User).all()
+        users[0].addresses
+    finally:
+        for signal in (signals.load, signals.lazy_load, signals.touch):
+            signal.disconnect(subscriber)
+    assert sent == []
+
+
+def test_ignore_scope(profiling):
+    sent = []
+    def worker():
+        session = signals.start_session()
+        signals.connect(signals.lazy_load, lambda sender, **kwargs: sent.append(sender))
+        signals.send(signals.lazy_load)
+        signals.end_session(session)
+    with signals.ignore(signals.lazy_load):
+        thread = threading.Thread(target=worker)
+        thread.start()
+        thread.join()
+    assert len(sent) == 1
+    assert profiling.ignored == {}
+
+
+def test_to_key():
+    to_key = nplusone.ext.sqlalchemy.to_key
+    primary_keys = nplusone.ext.sqlalchemy.primary_keys
+    assert to_key(models.User(id=1)) == (models.User, 1)
+    assert to_key(Membership(user_id=1, group='a')) == (Membership, (1, 'a'))
+    assert to_key(Membership()) == (Membership, (None, None))
+    assert primary_keys.get(models.User) is primary_keys.get(models.User)
+
+
+def test_instrument_relationships():
+    sa.orm.configure_mappers()
+    manager = models.User.__mapper__.class_manager
+    assert type(manager['addresses']) is RelationshipAttribute
+    assert type(manager['hobbies']) is RelationshipAttribute
+    assert type(models.Address.__mapper__.class_manager['user']) is RelationshipAttribute
+    assert type(manager['id']) is sa.orm.attributes.InstrumentedAttribute
+
+
+def test_uninstall(session, objects, calls):
+    nplusone.ext.sqlalchemy.uninstall()
+    try:
+        attr = vars(models.User)['addresses']
+        assert type(attr) is sa.orm.attributes.InstrumentedAttribute
+        users = session.query(models.User).all()
+        users[0].addresses
+        assert len(calls) == 0
+    finally:
+        nplusone.ext.sqlalchemy.install()
+    assert isinstance(vars(models.User)['addresses'], RelationshipAttribute)
+    session.expire_all()
+    users = session.query(models.User).all()
+    users[0].addresses
+    assert len(calls) == 1
+
+
+def test_install_deferred(session, objects):
+    patcher = nplusone.ext.sqlalchemy.patcher
+    nplusone.ext.sqlalchemy.uninstall()
+    patching.register(patcher)
+    assert not patcher.installed
+    with profiler.Profiler():
+        assert patcher.installed
+        users = session.query(models.User).all()
+        with pytest.raises(exceptions.NPlusOneError):
+            users[0].addresses
+
+
+def test_uninstall_pending(session, objects):
+    patcher = nplusone.ext.sqlalchemy.patcher
+    nplusone.ext.sqlalchemy.uninstall()
+    patching.register(patcher)
+    nplusone.ext.sqlalchemy.uninstall()
+    try:
+        with profiler.Profiler():
+            assert not patcher.installed
+    finally:
+        nplusone.ext.sqlalchemy.install()
@@ -5,21 +5,29 @@ from __future__ import absolute_import
 import mock
 import pytest
 
-from django.conf import settings
 from django.http.request import HttpRequest
 from django.http.response import HttpResponse
 
-from nplusone.ext.django.patch import setup_state
+try:
+    from django.urls import resolve
+except ImportError:  # pragma: no cover
+    from django.core.urlresolvers import resolve
+
+try:
+    from asgiref.sync import async_to_sync
+    from django.test import AsyncClient
+except ImportError:  # pragma: no cover
+    AsyncClient = None
+
+from nplusone.core import stats
+from nplusone.core import sampling
+from nplusone.core import signals
+from nplusone.ext.django import patch
 from nplusone.ext.django.middleware import NPlusOneMiddleware
 
 from . import models
 
 
-@pytest.fixture(scope='module', autouse=True)
-def setup():
-    setup_state()
-
-
 @pytest.fixture
 def objects():
     user = models.User.objects.create()
@@ -43,7 +51,7 @@ class TestOneToOne:
         occupation.user
         assert len(calls) == 1
         call = calls[0]
-        assert call.objects == (models.Occupation, 'Occupation:1', 'user')
+        assert call.objects == (models.Occupation, (models.Occupation, 1), 'user')
         assert 'occupation.user' in ''.join(call.frame[4])
 
     def test_one_to_one_select(self, objects, calls):
@@ -61,7 +69,7 @@ class TestOneToOne:
         user.occupation
         assert len(calls) == 1
         call = calls[0]
-        assert call.objects == (models.User, 'User:1', 'occupation')
+        assert call.objects == (models.User, (models.User, 1), 'occupation')
         assert 'user.occupation' in ''.join(call.frame[4])
 
 
@@ -73,7 +81,7 @@ class TestManyToOne:
         address.user
         assert len(calls) == 1
         call = calls[0]
-        assert call.objects == (models.Address, 'Address:1', 'user')
+        assert call.objects == (models.Address, (models.Address, 1), 'user')
         assert 'address.user' in ''.join(call.frame[4])
 
     def test_many_to_one_select(self, objects, calls):
@@ -91,7 +99,7 @@ class TestManyToOne:
         user.addresses.first()
         assert len(calls) == 1
         call = calls[0]
-        assert call.objects == (models.User, 'User:1', 'addresses')
+        assert call.objects == (models.User, (models.User, 1), 'addresses')
         assert 'user.addresses' in ''.join(call.frame[4])
 
     def test_many_to_one_reverse_no_related_name(self, objects, calls):
@@ -99,7 +107,7 @@ class TestManyToOne:
         user.pet_set.first()
         assert len(calls) == 1
         call = calls[0]
-        assert call.objects == (models.User, 'User:1', 'pet_set')
+        assert call.objects == (models.User, (models.User, 1), 'pet_set')
         assert 'user.pet_set' in ''.join(call.frame[4])
 
 
@@ -111,7 +119,7 @@ class TestManyToMany:
         list(users[0].hobbies.all())
         assert len(calls) == 1
         call = calls[0]
-        assert call.objects == (models.User, 'User:1', 'hobbies')
+        assert call.objects == (models.User, (models.User, 1), 'hobbies')
         assert 'users[0].hobbies' in ''.join(call.frame[4])
 
     def test_many_to_many_prefetch(self, objects, calls):
@@ -124,7 +132,7 @@ class TestManyToMany:
         list(hobbies[0].users.all())
         assert len(calls) == 1
         call = calls[0]
-        assert call.objects == (models.Hobby, 'Hobby:1', 'users')
+        assert call.objects == (models.Hobby, (models.Hobby, 1), 'users')
         assert 'hobbies[0].users' in ''.join(call.frame[4])
 
     def test_many_to_many_reverse_prefetch(self, objects, calls):
@@ -134,9 +142,9 @@ class TestManyToMany:
 
 
 @pytest.fixture
-def logger(monkeypatch):
+def logger(settings):
     mock_logger = mock.Mock()
-    monkeypatch.setattr(settings, 'NPLUSONE_LOGGER', mock_logger)
+    settings.NPLUSONE_LOGGER = mock_logger
     return mock_logger
 
 
@@ -172,7 +180,7 @@ class TestIntegration:
         pet.allergy_set.first()
         assert len(calls) == 1
         call = calls[0]
-        assert call.objects == (models.Pet, 'Pet:1', 'allergy_set')
+        assert call.objects == (models.Pet, (models.Pet, 1), 'allergy_set')
         assert 'pet.allergy_set' in ''.join(call.frame[4])
 
     def test_prefetch_one_to_one(self, objects, client, logger):
@@ -272,22 +280,130 @@ class TestIntegration:
         assert any('Pet.user' in call[1] for call in calls)
         assert any('User.occupation' in call[1] for call in calls)
 
-    def test_many_to_many_whitelist(self, objects, client, logger):
+    def test_many_to_many_whitelist(self, objects, client, logger, settings):
         settings.NPLUSONE_WHITELIST = [{'model': 'testapp.User'}]
         client.get('/many_to_many/')
         assert not logger.log.called
 
-    def test_many_to_many_whitelist_wildcard(self, objects, client, logger):
+    def test_many_to_many_whitelist_wildcard(self, objects, client, logger, settings):
         settings.NPLUSONE_WHITELIST = [{'model': 'testapp.*'}]
         client.get('/many_to_many/')
         assert not logger.log.called
 
+    def test_many_to_many_unsampled(self, objects, client, logger, settings):
+        settings.NPLUSONE_SAMPLE_RATE = 0
+        client.get('/many_to_many/')
+        assert not logger.log.called
+
+    def test_many_to_many_sample_rates(self, objects, client, logger, settings):
+        settings.NPLUSONE_SAMPLE_RATE = 0
+        settings.NPLUSONE_SAMPLE_RATES = {'testapp.views.many_to_many': 1}
+        client.get('/one_to_one/')
+        assert not logger.log.called
+        client.get('/many_to_many/')
+        assert logger.log.called
+
+    def test_stats_endpoint(self, objects, client, logger):
+        stats.reset()
+        client.get('/many_to_many/')
+        stat, = stats.snapshot()
+        assert stat.endpoint == 'testapp.views.many_to_many'
+        assert stat.model is models.User
+        stats.reset()
+
+    def test_stats_whitelist(self, objects, client, logger, settings):
+        stats.reset()
+        settings.NPLUSONE_WHITELIST = [{'model': 'testapp.User'}]
+        client.get('/many_to_many/')
+        assert stats.snapshot() == []
+
+    def test_setting_changed(self, objects, client, logger, settings):
+        client.get('/many_to_many/')
+        assert logger.log.call_count == 1
+        settings.NPLUSONE_WHITELIST = [{'model': 'testapp.User'}]
+        client.get('/many_to_many/')
+        assert logger.log.call_count == 1
+
+    def test_adaptive_sampling(self, objects, logger, settings, rf, monkeypatch):
+        monkeypatch.setattr(sampling.random, 'random', lambda: 0.3)
+        settings.NPLUSONE_SAMPLE_ADAPTIVE = True
+        settings.NPLUSONE_SAMPLE_DECAY = 0.5
+        settings.NPLUSONE_SAMPLE_FLOOR = 0.1
+        middleware = NPlusOneMiddleware(
+            lambda request: resolve(request.path_info).func(request)
+        )
+        clean, dirty = 'testapp.views.one_to_one_first', 'testapp.views.many_to_many'
+        for _ in range(3):
+            middleware(rf.get('/one_to_one_first/'))
+        middleware(rf.get('/many_to_many/'))
+        assert middleware.sampler.by_endpoint
+        assert middleware.get_endpoint(rf.get('/one_to_one_first/')) == clean
+        assert middleware.get_endpoint(rf.get('/missing/')) == '/missing/'
+        # The third request falls below the decayed rate and isn't profiled
+        state = middleware.endpoints[clean]
+        assert state.clean == 2
+        assert middleware.sampler.get_rate(clean) == 0.25
+        assert middleware.endpoints[dirty].last_detected is not None
+        assert middleware.sampler.get_rate(dirty) == 1
+        assert logger.log.call_count == 1
+        # Endpoint state outlives reloading the configuration
+        settings.NPLUSONE_SAMPLE_DECAY = 0.8
+        middleware(rf.get('/one_to_one_first/'))
+        assert middleware.sampler.decay == 0.8
+        assert middleware.endpoints[clean] is state
+        assert state.clean == 3
+        assert middleware.sampler.get_rate(clean) == 0.8 ** 3
+
 
 @pytest.mark.django_db
 def test_values(objects, lazy_listener):
     list(models.User.objects.values('id'))
 
 
+@pytest.mark.skipif(AsyncClient is None, reason='requires ASGI support')
+@pytest.mark.django_db
+def test_asgi(objects, logger):
+    client = AsyncClient()
+    response = async_to_sync(client.get)('/many_to_many/')
+    assert response.status_code == 200
+    assert len(logger.log.call_args_list) == 1
+    assert 'User.hobbies' in logger.log.call_args[0][1]
+    assert signals.get_session() is None
+
+
+@pytest.mark.django_db
+def test_uninstall(objects, calls):
+    patch.uninstall()
+    try:
+        users = models.User.objects.all()
+        list(users[0].hobbies.all())
+        assert len(calls) == 0
+    finally:
+        patch.install()
+    users = models.User.objects.all()
+    list(users[0].hobbies.all())
+    assert len(calls) == 1
+
+
+def test_field_names():
+    field = models.Pet._meta.get_field('user')
+    names = patch.field_names.get(field)
+    assert names == (models.User, 'pet')
+    assert patch.field_names.get(field) is names
+
+
+@pytest.mark.django_db
+def test_related_manager_call(objects, calls):
+    user = models.User.objects.first()
+    sizes = []
+    for _ in range(3):
+        list(user.hobbies(manager='objects').all())
+        list(user.pet_set(manager='objects').all())
+        sizes.append((len(patch.many_related_names), len(patch.related_names)))
+    assert len(calls) == 6
+    assert sizes[0] == sizes[-1]
+
+
 def test_middleware_no_process_request():
     middleware = NPlusOneMiddleware()
     req, resp = HttpRequest(), HttpResponse()